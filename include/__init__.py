@@ -1,5 +1,8 @@
+from include.plan import IncludeLimitExceeded
+from include.query import Include
 from include.query import IncludeQuerySet
+from include.query import include_objects
 from include.manager import IncludeManager
 
 __version__ = '0.2.4'
-__all__ = ('IncludeManager', 'IncludeQuerySet', )
+__all__ = ('Include', 'IncludeLimitExceeded', 'IncludeManager', 'IncludeQuerySet', 'include_objects', )
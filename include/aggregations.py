@@ -5,6 +5,7 @@ from django.db.models.aggregates import Aggregate
 
 class JSONAgg(OrderableAggMixin, Aggregate):
     function = 'JSON_AGG'
+    template = '%(function)s(%(expressions)s %(ordering)s)'
     allow_distinct = False
     contains_aggregate = False
 
@@ -1,14 +1,38 @@
+import itertools
+import time
+
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import JSONField
+from django.core.exceptions import FieldDoesNotExist
+from django.db import NotSupportedError
+from django.db.models import BooleanField
+from django.db.models import Count
 from django.db.models import Expression
+from django.db.models import IntegerField
+from django.db.models import TextField
+from django.db.models import Value
 from django.db.models.expressions import Func
+from django.db.models.functions import Cast
 from django.db.models.sql.constants import LOUTER
 from django.db.models.sql.datastructures import Join
 
+from include import signals
+from include import util
 from include.aggregations import JSONAgg
 
 
+class IncludeJSONField(JSONField):
+
+    def select_format(self, compiler, sql, params):
+        # Only called when selected by the outermost query. Fetch the JSON as text rather than letting
+        # the database driver decode it, so the decoder can be picked by INCLUDE_JSON_DECODER without
+        # changing how any other JSON is decoded. SQLite already sends JSON as text
+        if compiler.connection.vendor == 'postgresql':
+            return '({})::text'.format(sql), params
+        return sql, params
+
+
 class JSONBuildArray(Func):
     function = 'JSON_BUILD_ARRAY'
 
@@ -19,6 +43,21 @@ class JSONBuildArray(Func):
         return self.as_sql(compiler, connection, function='JSON_ARRAY', **extra_context)
 
 
+class JSONBuildObject(Func):
+    function = 'JSON_BUILD_OBJECT'
+
+    def __init__(self, *pairs, **kwargs):
+        # pairs of (key, expression), keys are sent as parameters
+        expressions = []
+        for key, expression in pairs:
+            expressions.extend((Value(key), expression))
+        kwargs.setdefault('output_field', JSONField())
+        super(JSONBuildObject, self).__init__(*expressions, **kwargs)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function='JSON_OBJECT', **extra_context)
+
+
 class IncludeExpressionConstructor(object):
 
     @property
@@ -29,15 +68,24 @@ class IncludeExpressionConstructor(object):
     def included_model(self):
         return self.field.related_model
 
-    def __init__(self, field, children=None):
+    def __init__(self, field, children=None, limit=None, fields=None, keyed=False, queryset=None, aggregate=None, max_bytes=None):
         self.field = field
+        self.limit = limit
+        # Rows are cut off once their JSON adds up to more than max_bytes, see ManyToOneConstructor.as_sql
+        self.max_bytes = max_bytes
+        self.keyed = keyed
+        self.queryset = queryset
+        # "count" or "exists" to select the number, or existence, of related rows rather than the rows themselves
+        self.aggregate = aggregate
+        self.fields = fields or self.included_model._meta.concrete_fields
         self.children = children or {}
 
     def get_joining_columns(self):
         return self.field.get_joining_columns()[0]
 
     def get_queryset(self):
-        qs = self.included_model.objects.all()
+        # Filters and ordering of an Include's queryset end up in the subquery, and the ordering of its aggregate
+        qs = self.included_model.objects.all() if self.queryset is None else self.queryset._chain()
 
         # Django's queries are amazing lazy. Calling get_initial_alias() seems
         # to be the fastest way to populate the internal alias structures so we can avoid any overlap
@@ -52,37 +100,67 @@ class IncludeExpressionConstructor(object):
 
         return queryset
 
-    def build_aggregate(self, queryset, compiler):
-        expressions = [f.column for f in self.included_model._meta.concrete_fields]
+    def build_row(self, queryset, compiler):
+        expressions = []
+        for field in self.fields:
+            if not self.keyed and compiler.connection.vendor == 'postgresql' and util.get_internal_type(field) == 'DecimalField':
+                # JSON numbers are parsed as floats, send decimals over as strings to keep their precision
+                expressions.append(Cast(field.attname, TextField()))
+            else:
+                expressions.append(field.attname)
 
         expressions.extend(self.children)
 
-        agg = JSONBuildArray(*expressions)
+        if self.keyed:
+            names = [field.attname for field in self.fields] + [child.plan.name for child in self.children]
+            return JSONBuildObject(*zip(names, expressions))
+
+        return JSONBuildArray(*expressions)
 
-        return agg
+    def build_aggregate(self, queryset, compiler):
+        return self.build_row(queryset, compiler)
 
-    def as_sql(self, compiler):
+    def as_sql(self, compiler, host_table):
         qs = self.get_queryset()
 
         # bump_prefix will effectively place this query's aliases into their own namespace
         # No need to worry about conflicting includes
         qs.query.bump_prefix(compiler.query)
+        # Query.base_table is cached, filters of an Include's queryset would leave it naming the alias from before bump_prefix
+        qs.query.__dict__.pop('base_table', None)
 
         table = qs.query.get_compiler(connection=compiler.connection).quote_name_unless_alias(qs.query.get_initial_alias())
-        host_table = compiler.query.resolve_ref('pk').alias
-
-        # # TODO be able to set limits per thing included
-        # if self._include_limit:
-        #     qs.query.set_limits(0, self._include_limit)
 
         agg = self.build_aggregate(qs, compiler)
         self.add_where(qs, host_table, table)
 
+        aliases = set(qs.query.alias_map)
         qs.query.add_annotation(agg, '__fields', is_summary=True)
+        self.prefix_aliases(qs.query, set(qs.query.alias_map) - aliases)
         sql, params = qs.values_list('__fields').query.sql_with_params()
 
+        if self.aggregate == 'exists':
+            return 'EXISTS ({})'.format(sql), params
+
         return '({})'.format(sql), params
 
+    def prefix_aliases(self, query, joined):
+        # Tables joined by nested includes may be aliased by their name, which could shadow the host table.
+        # Move them into the namespace set up by bump_prefix
+        suffixes = itertools.count(len(query.alias_map))
+        change_map = {}
+
+        for alias in [alias for alias in query.alias_map if alias in joined]:
+            if alias != query.alias_map[alias].table_name:
+                continue
+            new_alias = '{}{}'.format(query.alias_prefix, next(suffixes))
+            while new_alias in query.alias_map:
+                new_alias = '{}{}'.format(query.alias_prefix, next(suffixes))
+            change_map[alias] = new_alias
+
+        if change_map:
+            query.change_aliases(change_map)
+
     def _build_where(self, queryset, host_table, included_table):
         host_column, included_column = self.get_joining_columns()
 
@@ -100,18 +178,142 @@ class IncludeExpressionConstructor(object):
 class ManyToOneConstructor(IncludeExpressionConstructor):
 
     def build_aggregate(self, queryset, compiler):
+        if self.aggregate is not None:
+            # Ordering means nothing to, and would have to be grouped by with, COUNT(*)
+            queryset.query.clear_ordering(True)
+            return Count('*') if self.aggregate == 'count' else Value(1, output_field=IntegerField())
+
         agg = super(ManyToOneConstructor, self).build_aggregate(queryset, compiler)
 
+        if self.limit is not None or self.max_bytes is not None:
+            # A LIMIT next to an aggregate only limits the single aggregated row.
+            # Leave the rows, and their ordering, be and aggregate over the limited query in as_sql
+            if self.limit is not None:
+                queryset.query.set_limits(high=self.limit)
+            return agg
+
         # Any ordering needs to be plucked from the query set and added into the JSONAgg that we will be build
         # because SQL
         kwargs = {}
         if queryset.ordered:
-            kwargs['order_by'] = next(zip(*queryset.query.get_compiler(connection=compiler.connection).get_order_by()))
+            # Empty querysets claim to be ordered without ordering by anything
+            order_by = queryset.query.get_compiler(connection=compiler.connection).get_order_by()
+            if order_by:
+                kwargs['ordering'] = [expression for expression, _ in order_by]
         queryset.query.clear_ordering(True)
 
         # many_to_one is a bit of a misnomer, the field we have is the "one" side
         return JSONAgg(agg, **kwargs)
 
+    def as_sql(self, compiler, host_table):
+        if self.queryset is not None and self.queryset.query.is_empty():
+            # Like Prefetch, .none() includes nothing without a subquery. The same single row, named "__fields"
+            if self.aggregate == 'exists':
+                return 'EXISTS (SELECT 1 WHERE 1 = 0)', []
+            if self.aggregate == 'count':
+                return '(SELECT 0 AS "__fields")', []
+            # Typed, so include_json's COALESCE(..., '[]') stays JSON rather than text
+            return '(SELECT {} AS "__fields")'.format('NULL::json' if compiler.connection.vendor == 'postgresql' else 'NULL'), []
+
+        sql, params = super(ManyToOneConstructor, self).as_sql(compiler, host_table)
+
+        if self.limit is None and self.max_bytes is None:
+            return sql, params
+
+        if self.max_bytes is not None:
+            return self.guard(sql, compiler.connection), params
+
+        if compiler.connection.vendor == 'sqlite':
+            # JSON_GROUP_ARRAY would otherwise treat each row as a plain string
+            template = '(SELECT JSON_GROUP_ARRAY(JSON("__limited"."__fields")) AS "__fields" FROM {} "__limited")'
+        else:
+            template = '(SELECT JSON_AGG("__limited"."__fields") AS "__fields" FROM {} "__limited")'
+
+        return template.format(sql), params
+
+    def guard(self, sql, connection):
+        # Keeps rows while the running total of their size is within max_bytes. The first row over it is kept as a null,
+        # so overflowing can be told apart from fitting exactly, see IncludePlan.get_overflow
+        if connection.vendor == 'sqlite':
+            aggregate = 'JSON_GROUP_ARRAY(JSON({}))'
+            size = 'LENGTH(CAST("__limited"."__fields" AS BLOB))'
+        else:
+            aggregate = 'JSON_AGG({})'
+            size = 'OCTET_LENGTH("__limited"."__fields"::text)'
+
+        return (
+            '(SELECT {aggregate} FILTER (WHERE "__guarded"."__total" - "__guarded"."__size" <= {max_bytes}) AS "__fields" FROM ('
+            'SELECT "__limited"."__fields", {size} AS "__size", SUM({size}) OVER (ROWS UNBOUNDED PRECEDING) AS "__total" FROM {sql} "__limited"'
+            ') "__guarded")'
+        ).format(
+            aggregate=aggregate.format('CASE WHEN "__guarded"."__total" <= {:d} THEN "__guarded"."__fields" END'.format(self.max_bytes)),
+            max_bytes=int(self.max_bytes),
+            size=size,
+            sql=sql,
+        )
+
+
+class RecursiveConstructor(IncludeExpressionConstructor):
+    """Selects every row beneath the host through a self-referential reverse foreign key, up to max_depth levels deep.
+
+    The rows are found by a recursive CTE and aggregated flat, as [depth, *fields] ordered by depth,
+    and assembled into a tree by IncludePlan.assemble.
+    """
+
+    def __init__(self, field, max_depth, **kwargs):
+        super(RecursiveConstructor, self).__init__(field, **kwargs)
+        self.max_depth = max_depth
+
+    def get_ordering(self, connection):
+        # Siblings follow the default ordering of the model, as far as it names columns of its own
+        ordering = []
+        for name in self.included_model._meta.ordering:
+            if not isinstance(name, util.STR_TYPE):
+                continue
+            try:
+                field = self.included_model._meta.get_field(name.lstrip('-'))
+            except FieldDoesNotExist:
+                continue
+            if field.concrete:
+                ordering.append('"__tree".{} {}'.format(connection.ops.quote_name(field.column), 'DESC' if name.startswith('-') else 'ASC'))
+        ordering.append('"__tree".{} ASC'.format(connection.ops.quote_name(self.included_model._meta.pk.column)))
+        return ordering
+
+    def as_sql(self, compiler, host_table):
+        connection = compiler.connection
+        quote = connection.ops.quote_name
+        host_column, parent_column = self.get_joining_columns()
+
+        columns = ['"__tree"."__depth"']
+        for field in self.fields:
+            column = '"__tree".{}'.format(quote(field.column))
+            if connection.vendor == 'postgresql' and util.get_internal_type(field) == 'DecimalField':
+                # See IncludeExpressionConstructor.build_row
+                column = '({})::text'.format(column)
+            columns.append(column)
+
+        if connection.vendor == 'sqlite':
+            aggregate = 'JSON_GROUP_ARRAY(JSON_ARRAY({}))'
+        else:
+            aggregate = 'JSON_AGG(JSON_BUILD_ARRAY({}))'
+
+        return (
+            '(WITH RECURSIVE "__tree" AS ('
+            'SELECT 1 AS "__depth", "__node".* FROM {table} "__node" WHERE "__node".{parent} = {host_table}.{host} '
+            'UNION ALL '
+            'SELECT "__tree"."__depth" + 1, "__node".* FROM {table} "__node" INNER JOIN "__tree" ON "__node".{parent} = "__tree".{host} '
+            'WHERE "__tree"."__depth" < {max_depth:d}'
+            ') SELECT {aggregate} AS "__fields" FROM (SELECT * FROM "__tree" ORDER BY "__tree"."__depth", {ordering}) "__tree")'
+        ).format(
+            table=quote(self.included_model._meta.db_table),
+            parent=quote(parent_column),
+            host_table=host_table,
+            host=quote(host_column),
+            max_depth=self.max_depth,
+            aggregate=aggregate.format(', '.join(columns)),
+            ordering=', '.join(self.get_ordering(connection)),
+        ), []
+
 
 class GenericRelationConstructor(ManyToOneConstructor):
 
@@ -208,28 +410,222 @@ class ReverseManyToManyConstructor(ManyToOneConstructor):
         return queryset
 
 
+class LateralJoin(object):
+    """Joins the subquery of a collection include as LEFT JOIN LATERAL (...) ON TRUE, see IncludeExpression.
+
+    Quacks like a Join so it can live in Query.alias_map.
+    """
+
+    join_field = None
+    nullable = True
+    filtered_relation = None
+
+    def __init__(self, expression, parent_alias, table_alias=None, join_type=LOUTER):
+        self.expression = expression
+        self.table_name = '__include_{}'.format(expression.plan.name)
+        self.parent_alias = parent_alias
+        self.table_alias = table_alias
+        self.join_type = join_type
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor != 'postgresql':
+            raise NotSupportedError('Lateral includes are only supported by PostgreSQL')
+
+        # Don't bother joining includes that aren't selected, ie after .values() or .count()
+        if not any(getattr(annotation, 'join_alias', None) == self.table_alias for annotation in compiler.query.annotation_select.values()):
+            return '', []
+
+        sql, params = self.expression.compile(compiler, connection, self.parent_alias)
+
+        # The subquery selects a single row, its aggregate, named "__fields"
+        return '{} LATERAL {} {} ON TRUE'.format(self.join_type, sql, compiler.quote_name_unless_alias(self.table_alias)), params
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.expression,
+            change_map.get(self.parent_alias, self.parent_alias),
+            change_map.get(self.table_alias, self.table_alias),
+            self.join_type,
+        )
+
+    def equals(self, other, with_filtered_relation):
+        return (
+            isinstance(other, self.__class__)
+            and self.parent_alias == other.parent_alias
+            and self.expression.plan is other.expression.plan
+        )
+
+    def __eq__(self, other):
+        return self.equals(other, with_filtered_relation=True)
+
+    def demote(self):
+        return self.relabeled_clone({})
+
+    def promote(self):
+        return self.relabeled_clone({})
+
+
 class IncludeExpression(Expression):
     # No need to use group bys when using .include
     contains_aggregate = True
 
-    def __init__(self, field, children=None):
-        expressions = []
-        for cfield, kids in (children or {}).items():
-            expressions.append(IncludeExpression(cfield, kids))
+    def __init__(self, plan, nested=False, host_alias=None, host_model=None, lateral=False, keyed=False):
+        self.plan = plan
+        self.nested = nested
+        # Whether rows are built as JSON objects, keyed by name, for include_json rather than arrays
+        self.keyed = keyed
+        # Collection includes may be compiled as lateral joins rather than subqueries in the select list
+        self.lateral = lateral and plan.many and not nested and not plan.aggregate
+        # Where the included field lives, the base table of the query unless nested beneath a joined include
+        self.host_alias = host_alias
+        self.host_model = host_model
+        # Set by resolve_expression for includes compiled as joins
+        self.join_alias = None
+        self.joins = ()
+        self.children = ()
+        if plan.aggregate == 'count':
+            output_field = IntegerField()
+        elif plan.aggregate == 'exists':
+            output_field = BooleanField()
+        else:
+            output_field = IncludeJSONField()
+        super(IncludeExpression, self).__init__(output_field=output_field)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        c = super(IncludeExpression, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+        if c.lateral:
+            c.join_alias = query.join(LateralJoin(c, c.host_alias or query.get_initial_alias()))
+            c.joins = [c.join_alias]
+            return c
+
+        if not c.plan.join:
+            return c
+
+        # Single-valued fields are joined onto the query rather than selected by a correlated subquery.
+        # Any existing joins, ie from select_related or filters, are reused
+        host_alias = c.host_alias or query.get_initial_alias()
+        info = query.setup_joins([c.plan.field.name], (c.host_model or query.model)._meta, host_alias)
+        c.join_alias, c.joins = info.joins[-1], info.joins[1:]
+        c.children = [
+            IncludeExpression(child, nested=True, host_alias=c.join_alias, host_model=c.plan.model, keyed=c.keyed).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+            for child in c.plan.children
+        ]
 
+        return c
+
+    def relabeled_clone(self, change_map):
+        clone = super(IncludeExpression, self).relabeled_clone(change_map)
+        clone.host_alias = change_map.get(self.host_alias, self.host_alias)
+        clone.join_alias = change_map.get(self.join_alias, self.join_alias)
+        clone.joins = [change_map.get(alias, alias) for alias in self.joins]
+        clone.children = [child.relabeled_clone(change_map) for child in self.children]
+        return clone
+
+    def unref_joins(self, query):
+        """Release the joins added by resolve_expression, once this include is removed from query."""
+        for alias in self.joins:
+            query.unref_alias(alias)
+        for child in self.children:
+            child.unref_joins(query)
+
+    def get_group_by_cols(self, alias=None):
+        if not self.plan.join:
+            return []
+        # Everything selected from the joined table depends on its primary key
+        cols = [self.plan.model._meta.pk.get_col(self.join_alias)]
+        for child in self.children:
+            cols.extend(child.get_group_by_cols())
+        return cols
+
+    def get_constructor(self):
+        field = self.plan.field
+        expressions = [IncludeExpression(child, nested=True, keyed=self.keyed) for child in self.plan.children]
+        kwargs = {'limit': self.plan.limit, 'fields': self.plan.fields, 'keyed': self.keyed, 'queryset': self.plan.queryset, 'aggregate': self.plan.aggregate, 'max_bytes': self.plan.max_bytes}
+
+        if self.plan.max_depth is not None:
+            return RecursiveConstructor(field, self.plan.max_depth, fields=self.plan.fields)
         if isinstance(field, GenericRelation):
-            self._constructor = GenericRelationConstructor(field, expressions)
+            return GenericRelationConstructor(field, expressions, **kwargs)
         elif getattr(field, 'many_to_many', False):
             if field.auto_created:
-                self._constructor = ReverseManyToManyConstructor(field, expressions)
-            else:
-                self._constructor = ManyToManyConstructor(field, expressions)
+                return ReverseManyToManyConstructor(field, expressions, **kwargs)
+            return ManyToManyConstructor(field, expressions, **kwargs)
         elif getattr(field, 'multiple', False):
-            self._constructor = ManyToOneConstructor(field, expressions)
+            return ManyToOneConstructor(field, expressions, **kwargs)
+        return IncludeExpressionConstructor(field, expressions, **kwargs)
+
+    def as_join_sql(self, compiler, connection):
+        columns = []
+        for field in self.plan.fields:
+            column = field.get_col(self.join_alias)
+            if not self.keyed and connection.vendor == 'postgresql' and util.get_internal_type(field) == 'DecimalField':
+                # JSON numbers are parsed as floats, send decimals over as strings to keep their precision
+                column = Cast(column, TextField())
+            columns.append(column)
+
+        if self.keyed:
+            row = JSONBuildObject(*zip(self.plan.value_names + self.plan.child_names, columns + list(self.children)))
         else:
-            self._constructor = IncludeExpressionConstructor(field, expressions)
+            row = JSONBuildArray(*columns, *self.children)
+
+        sql, params = compiler.compile(row)
+        pk_sql, pk_params = compiler.compile(self.plan.model._meta.pk.get_col(self.join_alias))
+
+        # A missing row, from a nullable or reverse relation, must be NULL rather than an array of NULLs
+        return 'CASE WHEN {} IS NULL THEN NULL ELSE {} END'.format(pk_sql, sql), pk_params + params
+
+    def as_subquery_sql(self, compiler, connection, host_alias=None):
+        # The rendered subquery only depends on the plan, the database and the alias prefix of the outer query.
+        # Render it once with a placeholder for the host table and substitute the real alias every time after
+        key = (connection.alias, compiler.query.alias_prefix, self.keyed)
+
+        try:
+            sql, params = self.plan.sql[key]
+            cached = True
+        except KeyError:
+            sql, params = self.plan.sql[key] = self.get_constructor().as_sql(compiler, self.plan.HOST_ALIAS)
+            cached = False
+
+        host_alias = host_alias or self.host_alias or compiler.query.resolve_ref('pk').alias
 
-        super(IncludeExpression, self).__init__(output_field=JSONField())
+        return sql.replace(self.plan.HOST_ALIAS, compiler.quote_name_unless_alias(host_alias)), params, cached
 
     def as_sql(self, compiler, connection, template=None):
-        return self._constructor.as_sql(compiler)
+        if not self.lateral:
+            return self.compile(compiler, connection)
+
+        # The subquery is rendered, by LateralJoin, in the FROM clause
+        column = '{}."__fields"'.format(compiler.quote_name_unless_alias(self.join_alias))
+
+        if compiler.query.group_by is not None:
+            # JSON can't be grouped by. Every row of a group shares the same parent, and so the same lateral row
+            return '(ARRAY_AGG({}))[1]'.format(column), []
+
+        return column, []
+
+    def compile(self, compiler, connection, host_alias=None):
+        # Nested includes are compiled as part of, and timed with, their top level include
+        report = not self.nested and signals.include_compiled.has_listeners(compiler.query.model)
+        if report:
+            start = time.perf_counter()
+
+        if self.plan.join:
+            (sql, params), cached = self.as_join_sql(compiler, connection), False
+        else:
+            sql, params, cached = self.as_subquery_sql(compiler, connection, host_alias)
+
+        if self.keyed and self.plan.many and not self.plan.aggregate:
+            # Aggregating no rows is NULL, which is only dealt with when decoding
+            sql = "COALESCE({}, '[]')".format(sql)
+
+        if report:
+            signals.include_compiled.send(
+                sender=compiler.query.model,
+                path=self.plan.name,
+                plan=self.plan,
+                duration=time.perf_counter() - start,
+                cached=cached,
+            )
+
+        return sql, params
@@ -0,0 +1,251 @@
+"""Answer simple queries of included objects from memory, see IncludeQuerySet.include(in_memory=True).
+
+Related managers of included objects hand back querysets whose results are
+already loaded. When opted in, their class is swapped for one that filters,
+excludes and orders those results in Python whenever it can be sure the
+database would give back the same rows, and leaves everything else to the
+database.
+"""
+import operator
+import threading
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Model
+from django.utils import timezone
+
+from include import util
+
+
+# Types that compare and sort the same in Python as they do in the database
+ORDERED_TYPES = {
+    'AutoField', 'BigAutoField', 'BigIntegerField', 'BooleanField', 'DateField', 'DateTimeField', 'DecimalField', 'DurationField',
+    'FloatField', 'IntegerField', 'NullBooleanField', 'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField', 'TimeField',
+}
+
+# Types that only compare for equality the same way, string comparisons and ordering depend on the collation of the database
+EQUALITY_TYPES = ORDERED_TYPES | {'CharField', 'EmailField', 'SlugField', 'TextField', 'URLField', 'UUIDField'}
+
+# Vendors whose string equality is case sensitive, like Python's
+CASE_SENSITIVE_VENDORS = ('postgresql', 'sqlite')
+
+COMPARISONS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+LOOKUPS = {'exact', 'in', 'isnull', 'range'} | set(COMPARISONS)
+
+
+class Unsupported(Exception):
+    """Raised when a query can't be proven to give back the same rows in memory as it would from the database."""
+
+
+def get_field(model, name):
+    if name == 'pk':
+        return model._meta.pk
+
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        field = next((f for f in model._meta.concrete_fields if f.attname == name), None)
+
+    if field is None or field not in model._meta.concrete_fields:
+        raise Unsupported(name)
+
+    return field
+
+
+def to_python(field, value):
+    if hasattr(value, 'resolve_expression'):
+        raise Unsupported(value)
+
+    if isinstance(value, Model):
+        if not field.is_relation or not isinstance(value, field.related_model):
+            raise Unsupported(value)
+        value = getattr(value, field.target_field.attname)
+
+    target = field
+    while target.is_relation:
+        target = target.target_field
+
+    try:
+        value = target.to_python(value)
+    except (TypeError, ValidationError):
+        raise Unsupported(value)
+
+    # The database would make naive datetimes aware in the current timezone
+    if settings.USE_TZ and util.get_internal_type(field) == 'DateTimeField' and timezone.is_naive(value):
+        raise Unsupported(value)
+
+    return value
+
+
+def compile_lookup(model, lookup, value, using):
+    """Return (attname, function) of the field lookup is on and a function evaluating it like SQL would, True, False or None for unknown."""
+    name, _, kind = lookup.partition('__')
+    kind = kind or 'exact'
+
+    if kind not in LOOKUPS:
+        raise Unsupported(lookup)
+
+    field = get_field(model, name)
+    attname = field.attname
+    internal_type = util.get_internal_type(field)
+
+    if internal_type not in (ORDERED_TYPES if kind in COMPARISONS or kind == 'range' else EQUALITY_TYPES):
+        raise Unsupported(lookup)
+
+    if internal_type not in ORDERED_TYPES and connections[using].vendor not in CASE_SENSITIVE_VENDORS:
+        raise Unsupported(lookup)
+
+    if kind == 'exact' and value is None:
+        kind, value = 'isnull', True
+
+    if kind == 'isnull':
+        if not isinstance(value, bool):
+            raise Unsupported(lookup)
+        return attname, lambda obj: (getattr(obj, attname) is None) == value
+
+    if kind == 'in':
+        # Anything else may be a subquery, or an iterator already consumed building the query
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            raise Unsupported(lookup)
+        # NULLs never match IN
+        values = {to_python(field, v) for v in value if v is not None}
+        return attname, lambda obj: None if getattr(obj, attname) is None else getattr(obj, attname) in values
+
+    if kind == 'range':
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise Unsupported(lookup)
+        low, high = (to_python(field, v) for v in value)
+        if low is None or high is None:
+            raise Unsupported(lookup)
+        return attname, lambda obj: None if getattr(obj, attname) is None else low <= getattr(obj, attname) <= high
+
+    value = to_python(field, value)
+    if value is None:
+        raise Unsupported(lookup)
+
+    compare = COMPARISONS.get(kind, operator.eq)
+    return attname, lambda obj: None if getattr(obj, attname) is None else compare(getattr(obj, attname), value)
+
+
+def filter_results(queryset, negate, args, kwargs):
+    """Return the loaded results of queryset filtered, or excluded if negate, by kwargs."""
+    if args:
+        raise Unsupported(args)
+
+    compiled = [compile_lookup(queryset.model, lookup, value, queryset.db) for lookup, value in kwargs.items()]
+    check_loaded(queryset._result_cache, [attname for attname, _ in compiled])
+    lookups = [lookup for _, lookup in compiled]
+
+    # filter(a, b) keeps rows where both are true, exclude(a, b) anything else, NULLs included
+    return [
+        obj for obj in queryset._result_cache
+        if all(lookup(obj) is True for lookup in lookups) != negate
+    ]
+
+
+def order_results(queryset, field_names):
+    """Return the loaded results of queryset sorted by field_names."""
+    results = list(queryset._result_cache)
+
+    keys = []
+    for name in field_names:
+        if not isinstance(name, util.STR_TYPE) or name == '?':
+            raise Unsupported(name)
+        descending, name = name.startswith('-'), name.lstrip('-')
+        field = get_field(queryset.model, name)
+        if util.get_internal_type(field) not in ORDERED_TYPES:
+            raise Unsupported(name)
+        # Ordering by a relation, rather than its column, uses the default ordering of the related model
+        if field.is_relation and name != field.attname and field.related_model._meta.ordering:
+            raise Unsupported(name)
+        keys.append((field.attname, descending))
+
+    check_loaded(results, [attname for attname, _ in keys])
+
+    # Where NULLs sort depends on the database
+    if any(getattr(obj, attname) is None for obj in results for attname, _ in keys):
+        raise Unsupported(field_names)
+
+    # Stable sorts, least significant key first
+    for attname, descending in reversed(keys):
+        results.sort(key=operator.attrgetter(attname), reverse=descending)
+
+    return results
+
+
+def check_loaded(objs, attnames):
+    # Deferred fields would be loaded with a query per object
+    for obj in objs:
+        for attname in attnames:
+            if attname not in obj.__dict__:
+                raise Unsupported(attname)
+
+
+class InMemoryQuerySetMixin(object):
+    """Answers .filter, .exclude, .order_by and .all of a queryset with loaded results from memory.
+
+    .count, .exists, .first, .last and slicing already use loaded results.
+    """
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        clone = super(InMemoryQuerySetMixin, self)._filter_or_exclude(negate, *args, **kwargs)
+        if self._result_cache is not None:
+            try:
+                clone._set_results(filter_results(self, negate, args, kwargs))
+            except Unsupported:
+                pass
+        return clone
+
+    def order_by(self, *field_names):
+        clone = super(InMemoryQuerySetMixin, self).order_by(*field_names)
+        if self._result_cache is not None:
+            try:
+                clone._set_results(order_results(self, field_names))
+            except Unsupported:
+                pass
+        return clone
+
+    def all(self):
+        clone = super(InMemoryQuerySetMixin, self).all()
+        if self._result_cache is not None:
+            clone._set_results(list(self._result_cache))
+        return clone
+
+    def _set_results(self, results):
+        self._result_cache = results
+        self._prefetch_done = True
+
+    def __reduce__(self):
+        # Pickle as the queryset class this one was made from, its results are pickled along with it regardless
+        return (restore, (type(self).__bases__[1], self.__getstate__()))
+
+
+def restore(cls, state):
+    queryset = cls.__new__(cls)
+    queryset.__setstate__(state)
+    return queryset
+
+
+_classes = {}
+_lock = threading.Lock()
+
+
+def get_class(cls):
+    """Return the in memory counterpart of the queryset class cls."""
+    if issubclass(cls, InMemoryQuerySetMixin):
+        return cls
+
+    with _lock:
+        try:
+            return _classes[cls]
+        except KeyError:
+            memory_cls = _classes[cls] = type('InMemory' + cls.__name__, (InMemoryQuerySetMixin, cls), {})
+            return memory_cls
@@ -0,0 +1,363 @@
+import copy
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+
+from include import util
+
+
+# What happens to the objects included for a parent beyond max_elements or max_bytes, see IncludeQuerySet.include
+OVERFLOWS = ('raise', 'truncate', 'lazy')
+
+
+class IncludeLimitExceeded(Exception):
+    """Raised when the objects included for a parent exceed max_elements or max_bytes with overflow="raise"."""
+
+
+class IncludeTree(OrderedDict):
+    """An ordered mapping of {key: IncludeTree} describing everything included beneath a field.
+
+    Trees are keyed by their field, or (field, to_attr) when included to an
+    attribute of their own, see include.query.Include. Per path options, such
+    as limit_includes, are stored as attributes on the tree of the field they
+    apply to.
+    """
+
+    limit = None
+    # A queryset of the included model to filter and order by, see include.query.Include
+    queryset = None
+    to_attr = None
+    # "count" or "exists" when only the number, or existence, of related rows is included, see IncludeQuerySet.include_count
+    aggregate = None
+    only = None
+    defer = None
+    # How a top level include is loaded, see include.strategy. Has no effect on the compiled plan
+    strategy = 'json'
+    # Whether a top level include only selects the keys of related rows, loading the rows themselves once per chunk
+    normalize = False
+    # Guards against pathological parents, see IncludeQuerySet.include
+    max_elements = None
+    max_bytes = None
+    overflow = 'raise'
+    # Set when a self-referential field is included recursively, the whole subtree up to max_depth levels deep
+    max_depth = None
+    # (queryset, its key), see get_queryset_key
+    _queryset_key = (None, None)
+
+    def __init__(self, field=None, *args, **kwargs):
+        super(IncludeTree, self).__init__(*args, **kwargs)
+        # None for the root of the tree
+        self.field = field
+
+    def __deepcopy__(self, memo):
+        # Fields are shared, only the structure of the tree and its options need copying.
+        # Deep copying related objects would also break lookups by field
+        clone = copy.copy(self)
+        for field, tree in clone.items():
+            clone[field] = copy.deepcopy(tree, memo)
+        return clone
+
+    @staticmethod
+    def get_key(field, to_attr=None):
+        return field if to_attr is None else (field, to_attr)
+
+    @property
+    def name(self):
+        """Where included objects end up, and what they are selected as."""
+        return self.to_attr or self.field.name
+
+    def walk(self):
+        """Yield every tree beneath this one, depth first."""
+        for tree in self.values():
+            yield tree
+            yield from tree.walk()
+
+    def key(self):
+        # Querysets compare, and hash, by identity. Equal filters and orderings share a plan, by their SQL
+        if self._queryset_key[0] is not self.queryset:
+            self._queryset_key = (self.queryset, get_queryset_key(self.queryset))
+        guards = (self.max_elements, self.max_bytes, self.overflow)
+        return (self.limit, self.only, self.defer, self._queryset_key[1], self.to_attr, self.aggregate, guards, self.max_depth, tuple((field_key(tree.field), tree.key()) for tree in self.values()))
+
+
+class IncludePlan(object):
+    """The compiled, reusable form of including a field and everything beneath it.
+
+    Plans are cached by get_plan and hold everything that does not vary between
+    querysets: the layout of the included columns, how to decode them and the
+    rendered SQL of the include subquery.
+    """
+
+    # Stands in for the alias of the host table in cached SQL
+    HOST_ALIAS = '"__include_host__"'
+
+    def __init__(self, field, tree=None):
+        if tree is None:
+            tree = IncludeTree(field)
+
+        self.field = field
+        self.model = field.related_model
+        self.limit = tree.limit
+        self.max_elements = tree.max_elements
+        self.max_bytes = tree.max_bytes
+        self.overflow = tree.overflow
+        self.guarded = tree.max_elements is not None or tree.max_bytes is not None
+        # Whether the objects included for a parent may be only some of its related objects, when limited, filtered or guarded
+        self.partial = tree.limit is not None or tree.queryset is not None or self.guarded
+        if self.max_elements is not None and (self.limit is None or self.limit > self.max_elements):
+            # One more than allowed, to tell whether there were too many
+            self.limit = self.max_elements + 1
+        self.many = not (field.many_to_one or field.one_to_one)
+        # Single-valued fields are joined, unless multi-table inheritance would spread the included model over several tables
+        self.join = not self.many and not self.model._meta.concrete_model._meta.parents
+        self.queryset = tree.queryset
+        self.to_attr = tree.to_attr
+        self.aggregate = tree.aggregate
+        self.max_depth = tree.max_depth
+        self.children = [get_plan(t.field, t) for t in tree.values()]
+
+        self.fields = util.get_concrete_fields(self.model, tree.only, tree.defer)
+
+        if self.max_depth is not None:
+            # Rows are assembled into a tree by their foreign key, which has to be loaded, see assemble
+            parent, key = field.field, field.field.target_field
+            if parent not in self.fields or key not in self.fields:
+                self.fields = tuple(f for f in self.model._meta.concrete_fields if f in self.fields or f in (parent, key))
+            self.parent_index, self.key_index = self.fields.index(parent), self.fields.index(key)
+        # from_db will mark anything not in field_names as deferred
+        self.field_names = None if self.fields is self.model._meta.concrete_fields else [f.attname for f in self.fields]
+        # Keys of the dicts built by to_values
+        self.value_names = [f.attname for f in self.fields]
+        self.child_names = [child.name for child in self.children]
+        # The primary key is always loaded, see util.get_concrete_fields
+        self.pk_index = self.fields.index(self.model._meta.pk)
+
+        # {database alias: [(index, json converter, [db converters], expression, connection)]}, see build_decoder
+        self.decoders = {}
+
+        if field.remote_field.concrete and not field.many_to_many:
+            self.remote_cache_name = field.remote_field.get_cache_name()
+        else:
+            self.remote_cache_name = None
+
+        if hasattr(field, 'get_accessor_name'):
+            self.accessor_name = field.get_accessor_name()
+        else:
+            self.accessor_name = field.name
+
+        # Where related managers and descriptors look for cached objects,
+        # _prefetched_objects_cache for many-valued fields otherwise _state.fields_cache
+        if not self.many:
+            self.cache_name = field.get_cache_name()
+        elif field.many_to_many and field.auto_created:
+            self.cache_name = field.field.related_query_name()
+        elif field.many_to_many:
+            self.cache_name = field.name
+        else:
+            self.cache_name = self.accessor_name
+
+        # Where included objects end up, by field name unless included to an attribute of their own
+        self.name = tree.to_attr or field.name
+        self.annotation_name = '__' + self.name
+        # {(connection alias, alias prefix, keyed): (sql, params)}
+        self.sql = {}
+
+    def build_decoder(self, connection):
+        decoder = []
+
+        for i, field in enumerate(self.fields):
+            expression = field.get_col(self.model._meta.db_table)
+            backend_converters = connection.ops.get_db_converters(expression)
+
+            # Fun caveat of throwing everything into JSON, it doesn't support datetimes, decimals, etc.
+            # Everything gets sent back as strings. Backends that have converters of their own, ie SQLite,
+            # already expect that, otherwise the values need to be parsed into what the database driver would have returned.
+            json_converter = None if backend_converters else util.JSON_CONVERTERS.get(util.get_internal_type(field))
+            converters = backend_converters + expression.get_db_converters(connection)
+
+            if json_converter or converters:
+                decoder.append((i, json_converter, converters, expression, connection))
+
+        return decoder
+
+    def decode(self, db, data):
+        """Split a row of raw JSON data into the decoded values of self.fields and the raw data of its children."""
+        values, nested = data[:len(self.fields)], data[len(self.fields):]
+
+        try:
+            decoder = self.decoders[db]
+        except KeyError:
+            decoder = self.decoders[db] = self.build_decoder(connections[db])
+
+        for i, json_converter, converters, expression, connection in decoder:
+            value = values[i]
+            if json_converter is not None and value is not None:
+                value = json_converter(value)
+            for converter in converters:
+                value = converter(value, expression, connection)
+            values[i] = value
+
+        return values, nested
+
+    def assemble(self, db, data, build):
+        """Build the flat rows of a recursive include, [depth, *values] ordered by depth, into a tree.
+
+        Every row is built by build(values, children), deepest first so its children are built
+        before it. children is None for rows at max_depth, whose children were not loaded.
+        Returns the built rows of the first level.
+        """
+        # {parent key: [built children, in reverse]}
+        children, roots = {}, []
+
+        for row in reversed(data or ()):
+            depth, (values, _) = row[0], self.decode(db, row[1:])
+            node = build(values, children.pop(values[self.key_index], [])[::-1] if depth < self.max_depth else None)
+            (roots if depth == 1 else children.setdefault(values[self.parent_index], [])).append(node)
+
+        return roots[::-1]
+
+    def get_overflow(self, data):
+        """Return which guard data, the rows included for a single parent, exceeds, "elements", "bytes" or None."""
+        # Rows beyond max_bytes are cut off in SQL, leaving a null in place of the first one, see ManyToOneConstructor
+        if self.max_bytes is not None and data and data[-1] is None:
+            return 'bytes'
+        if self.max_elements is not None and len(data) > self.max_elements:
+            return 'elements'
+        return None
+
+    def truncate(self, data):
+        if self.max_bytes is not None and data and data[-1] is None:
+            data = data[:-1]
+        return data if self.max_elements is None else data[:self.max_elements]
+
+    def check(self, data, instance=None):
+        """Return data truncated by the guards of this plan, or raise IncludeLimitExceeded unless overflow="truncate"."""
+        reason = self.get_overflow(data)
+        if reason is None:
+            return data
+        if self.overflow != 'truncate':
+            raise IncludeLimitExceeded('The objects included at "{}"{} exceed max_{}'.format(
+                self.name,
+                '' if instance is None else ' of {!r}'.format(instance),
+                reason,
+            ))
+        return self.truncate(data)
+
+    def from_aggregate(self, data):
+        # SQLite has no booleans, EXISTS is 0 or 1
+        return bool(data) if self.aggregate == 'exists' else data
+
+    def from_db(self, db, data):
+        values, nested = self.decode(db, data)
+
+        # from_db expects the final argument to be a tuple of fields in the order of concrete_fields
+        return self.model.from_db(db, self.field_names, values), nested
+
+    def to_values(self, db, data, named=True):
+        """Build the raw data of this include into dicts of {name: value}, or tuples if not named, rather than model instances.
+
+        Many-valued fields become a list, single-valued fields a single dict or None.
+        Values are keyed by attname and includes beneath this one by field name.
+        """
+        if self.aggregate:
+            return self.from_aggregate(data)
+
+        if self.max_depth is not None:
+            names = self.value_names + [self.name]
+
+            def build(values, children):
+                # Rows at max_depth go without their children, which were not loaded
+                if children is not None:
+                    values = values + [children]
+                return dict(zip(names, values)) if named else tuple(values)
+
+            return self.assemble(db, data, build)
+
+        if self.guarded and data:
+            # Nothing to fall back to lazily, ie overflow="lazy" raises
+            data = self.check(data)
+
+        rows = []
+
+        for row in (data or ()) if self.many else (data, ):
+            if row is None:
+                rows.append(None)
+                continue
+
+            values, nested = self.decode(db, row)
+            children = [child.to_values(db, d, named) for child, d in zip(self.children, nested)]
+
+            if named:
+                row = dict(zip(self.value_names, values))
+                row.update(zip(self.child_names, children))
+                rows.append(row)
+            else:
+                rows.append(tuple(values + children))
+
+        return rows if self.many else rows[0]
+
+    def __repr__(self):
+        return '<{}({})>'.format(type(self).__name__, self.field.name)
+
+
+class _PlanCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+            return plan
+
+    def set(self, key, plan):
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > getattr(settings, 'INCLUDE_PLAN_CACHE_SIZE', 256):
+                self._plans.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+plans = _PlanCache()
+
+
+def get_queryset_key(queryset):
+    """Return the SQL and params of queryset to key plans by, or queryset itself when they can't be."""
+    if queryset is None:
+        return None
+
+    try:
+        sql, params = queryset.query.clone().get_compiler(using=queryset.db).as_sql()
+        # Typed, 1 and True hash the same
+        key = (queryset.model, sql, tuple((type(param), param) for param in params))
+        hash(key)
+    except (EmptyResultSet, TypeError):
+        return queryset
+
+    return key
+
+
+def field_key(field):
+    # Fields compare by creation_counter alone, which is shared by fields inherited from abstract models
+    return (field.model, field.name)
+
+
+def get_plan(field, tree=None):
+    """Return the, possibly cached, IncludePlan for including field and tree."""
+    key = (field_key(field), (IncludeTree(field) if tree is None else tree).key())
+
+    plan = plans.get(key)
+    if plan is None:
+        plan = IncludePlan(field, tree)
+        plans.set(key, plan)
+
+    return plan
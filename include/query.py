@@ -1,12 +1,111 @@
 import copy
-from collections import OrderedDict
+import itertools
+import threading
+import time
 
 from django.db import models
+from django.core.exceptions import EmptyResultSet
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import F
+from django.db.models import Prefetch
+from django.db.models import prefetch_related_objects
+from django.db.models.query import FlatValuesListIterable
 from django.db.models.query import ModelIterable
+from django.db.models.query import ValuesIterable
+from django.db.models.query import ValuesListIterable
 from django.db.models.fields.reverse_related import ForeignObjectRel
 
+from include import memory
+from include import signals
+from include import strategy
 from include import util
 from include.expressions import IncludeExpression
+from include.expressions import IncludeJSONField
+from include.expressions import JSONBuildObject
+from include.plan import OVERFLOWS
+from include.plan import IncludeTree
+from include.plan import get_plan
+
+
+class Include(object):
+    """A path to include, optionally filtered and ordered by queryset and stored on a list, or attribute, named to_attr.
+
+    Like Prefetch, including the same relation to several attributes, each
+    with a queryset of its own, is fine. Paths may continue beneath a to_attr:
+
+        Cat.objects.include(
+            Include('memberships', queryset=Membership.objects.filter(active=True).order_by('-joined'), to_attr='active_memberships'),
+            'active_memberships__organization',
+        )
+    """
+
+    def __init__(self, path, queryset=None, to_attr=None):
+        self.path = path
+        self.queryset = queryset
+        self.to_attr = to_attr
+
+    def __repr__(self):
+        return '<{}({!r})>'.format(type(self).__name__, self.path)
+
+
+class TruncatedList(list):
+    """The objects included to an attribute, cut short by max_elements or max_bytes, see IncludeQuerySet.include."""
+
+    truncated = True
+
+
+class LazyIncludeCache(dict):
+    """A _prefetched_objects_cache or _state.fields_cache that hydrates included objects on first access.
+
+    Related managers and descriptors look up their cached objects by key,
+    __missing__ hydrates the raw data of the include on demand.
+    """
+
+    def __init__(self, instance, *args, **kwargs):
+        super(LazyIncludeCache, self).__init__(*args, **kwargs)
+        self.instance = instance
+        # {cache name: (plan, data, path, report, identities, in_memory)}
+        self.pending = {}
+
+    def __missing__(self, key):
+        try:
+            plan, data, path, report, identities, in_memory = self.pending.pop(key)
+        except KeyError:
+            raise KeyError(key)
+
+        IncludeModelIterable.parse_nested(self.instance, plan, data, lazy=True, path=path, report=report, identities=identities, in_memory=in_memory)
+        if report is not None:
+            report.send()
+
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.pending or super(LazyIncludeCache, self).__contains__(key)
+
+    def __delitem__(self, key):
+        pending = self.pending.pop(key, None)
+        if pending is None or super(LazyIncludeCache, self).__contains__(key):
+            super(LazyIncludeCache, self).__delitem__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *args):
+        self.pending.pop(key, None)
+        return super(LazyIncludeCache, self).pop(key, *args)
+
+    def copy(self):
+        # Model.__getstate__ copies the fields cache when pickling, hand back a plain dict of everything
+        for key in list(self.pending):
+            self[key]
+        return dict(self)
+
+    def __reduce__(self):
+        return (dict, (self.copy(), ))
 
 
 class IncludeModelIterable(ModelIterable):
@@ -15,83 +114,397 @@ class IncludeModelIterable(ModelIterable):
     # Hook in here to pluck off the extra json aggregations that were tacked on
 
     @classmethod
-    def parse_nested(cls, instance, field, nested, datas):
-        if field.many_to_one or field.one_to_one:
+    def defer_nested(cls, instance, plan, datas, path=None, report=None, identities=None, in_memory=False):
+        if plan.many:
+            cache = getattr(instance, '_prefetched_objects_cache', None)
+        else:
+            cache = instance._state.fields_cache
+
+        if not isinstance(cache, LazyIncludeCache):
+            cache = LazyIncludeCache(instance, cache or ())
+            if plan.many:
+                instance._prefetched_objects_cache = cache
+            else:
+                instance._state.fields_cache = cache
+
+        cache.pending[plan.cache_name] = (plan, datas, path, report, identities, in_memory)
+
+    @classmethod
+    def parse_nested(cls, instance, plan, datas, lazy=False, path=None, report=None, identities=None, in_memory=False):
+        if plan.aggregate:
+            # Counts and exists are plain values, see IncludeQuerySet.include_count
+            setattr(instance, plan.to_attr, plan.from_aggregate(datas))
+            return
+
+        if plan.max_depth is not None:
+            cls.parse_recursive(instance, plan, datas, path=path, report=report, in_memory=in_memory)
+            return
+
+        # Paths are only needed to report on, don't bother building them otherwise
+        if report is None:
+            paths = itertools.repeat(None)
+        else:
+            start = time.perf_counter()
+            paths = ['{}__{}'.format(path, child.name) for child in plan.children]
+
+        truncated = False
+        if plan.guarded and datas:
+            reason = plan.get_overflow(datas)
+            if reason is not None:
+                if report is not None:
+                    report.overflowed(path, plan, instance, reason)
+                if plan.overflow == 'lazy':
+                    # Left to the related manager, which queries for all of them
+                    return
+                datas, truncated = plan.check(datas, instance), True
+
+        if not plan.many:
             datas = (datas, )
         ps = []
 
-        # Fun caveat of throwing everything into JSON, it doesn't support datetimes. Everything gets sent back as iso8601 strings
-        # Make a list of all fields that should be datetimes and parse them ahead of time
-        dts = [i for i, f in enumerate(field.related_model._meta.concrete_fields) if isinstance(f, models.DateTimeField)]
-
         for data in datas or []:
             if data is None:
                 ps.append(None)
                 continue
 
-            data, nested_data = data[:-len(nested) or None], data[-len(nested):]
+            # The same row, included through the same plan, always carries the same nested data. Hydrate it once and share it
+            if identities is not None:
+                key = (plan, data[plan.pk_index])
+                parsed = identities.get(key)
+                if parsed is not None:
+                    ps.append(parsed)
+                    continue
 
-            for i in dts:
-                data[i] = util.parse_datetime(data[i])
+            parsed, nested_data = plan.from_db(instance._state.db, data)
 
-            # from_db expects the final argument to be a tuple of fields in the order of concrete_fields
-            parsed = field.related_model.from_db(instance._state.db, None, data)
+            for child, d, child_path in zip(plan.children, nested_data, paths):
+                # Attributes can't be hydrated on access, unlike the caches of related managers and descriptors
+                if lazy and not child.to_attr:
+                    cls.defer_nested(parsed, child, d, path=child_path, report=report, identities=identities, in_memory=in_memory)
+                else:
+                    cls.parse_nested(parsed, child, d, path=child_path, report=report, identities=identities, in_memory=in_memory)
 
-            for (f, n), d in zip(nested.items(), nested_data):
-                cls.parse_nested(parsed, f, n, d)
+            if identities is not None:
+                identities[key] = parsed
 
-            if field.remote_field.concrete and not field.many_to_many:
-                setattr(parsed, field.remote_field.get_cache_name(), instance)
+            if plan.remote_cache_name:
+                setattr(parsed, plan.remote_cache_name, instance)
 
             ps.append(parsed)
 
-        if (field.many_to_one or field.one_to_one) and ps:
-            instance._state.fields_cache[field.get_cache_name()] = ps[0]
-            return
+        if truncated and plan.to_attr:
+            setattr(instance, plan.to_attr, TruncatedList(ps))
+        elif plan.to_attr:
+            setattr(instance, plan.to_attr, ps if plan.many else ps[0])
+        elif not plan.many:
+            instance._state.fields_cache[plan.cache_name] = ps[0]
+        else:
+            # Whatever's missing from truncated objects can't be answered from memory
+            cls.cache_many(instance, plan, ps, in_memory=in_memory and not truncated)
+            if truncated:
+                instance._prefetched_objects_cache[plan.cache_name].truncated = True
+
+        if report is not None:
+            report.hydrated(path, plan, len(ps) - ps.count(None), time.perf_counter() - start)
 
+    @classmethod
+    def parse_recursive(cls, instance, plan, datas, path=None, report=None, in_memory=False):
+        # Built bottom up rather than recursively, trees may be deeper than Python's recursion limit
+        if report is not None:
+            start, rows = time.perf_counter(), len(datas or ())
+        db = instance._state.db
+
+        def build(values, children):
+            obj = plan.model.from_db(db, plan.field_names, values)
+            # Children of the deepest rows were not loaded, their related managers query for them
+            if children is not None:
+                for child in children:
+                    setattr(child, plan.remote_cache_name, obj)
+                cls.cache_many(obj, plan, children, in_memory=in_memory)
+            return obj
+
+        roots = plan.assemble(db, datas, build)
+        for root in roots:
+            setattr(root, plan.remote_cache_name, instance)
+        cls.cache_many(instance, plan, roots, in_memory=in_memory)
+
+        if report is not None:
+            report.hydrated(path, plan, rows, time.perf_counter() - start)
+
+    @classmethod
+    def cache_many(cls, instance, plan, objs, in_memory=False):
         if not hasattr(instance, '_prefetched_objects_cache'):
             instance._prefetched_objects_cache = {}
 
-        if hasattr(field, 'get_accessor_name'):
-            accessor_name = field.get_accessor_name()
-        else:
-            accessor_name = field.name
+        # get_queryset() sets a bunch of attributes for us and will respect any custom managers
+        instance._prefetched_objects_cache[plan.cache_name] = getattr(instance, plan.accessor_name).get_queryset()
+        # Only all of the related objects answer for the related manager, not some of them
+        if in_memory and not plan.partial:
+            # Simple filters and orderings of the included objects are answered without a query, see include.memory
+            queryset = instance._prefetched_objects_cache[plan.cache_name]
+            queryset.__class__ = memory.get_class(queryset.__class__)
+        instance._prefetched_objects_cache[plan.cache_name]._result_cache = objs
+        instance._prefetched_objects_cache[plan.cache_name]._prefetch_done = True
+
+    @classmethod
+    def parse_normalized(cls, chunk, field, tree, queryset, in_memory=False):
+        """Load the rows referenced by a chunk of instances, once each, and cache them on every instance referencing them."""
+        plan = get_plan(field, tree)
 
-        if field.many_to_many:
-            prefetch_cache_name = getattr(instance, accessor_name).prefetch_cache_name
+        if not plan.many:
+            # Forward foreign keys reference the related row by a column of their own
+            key_field = field.target_field
+            keys = [getattr(instance, field.attname) for instance in chunk]
         else:
-            prefetch_cache_name = accessor_name
+            # Otherwise the keys were included, see IncludeQuerySet._include
+            key_field = plan.model._meta.pk
+            keys = []
+            for instance in chunk:
+                data = instance.__dict__.pop(plan.annotation_name)
+                if isinstance(data, util.STR_TYPE):
+                    data = util.get_json_loads()(data)
+                keys.append([key_field.to_python(row[0]) for row in data or ()])
 
-        # get_queryset() sets a bunch of attributes for us and will respect any custom managers
-        instance._prefetched_objects_cache[prefetch_cache_name] = getattr(instance, accessor_name).get_queryset()
-        instance._prefetched_objects_cache[prefetch_cache_name]._result_cache = ps
-        instance._prefetched_objects_cache[prefetch_cache_name]._prefetch_done = True
+        unique = set(itertools.chain.from_iterable(keys)) if plan.many else set(keys)
+        unique.discard(None)
+
+        rows = {}
+        if unique:
+            rows = {getattr(obj, key_field.attname): obj for obj in queryset.filter(**{key_field.attname + '__in': unique})}
+
+        for instance, key in zip(chunk, keys):
+            if plan.many:
+                cls.cache_many(instance, plan, [rows[k] for k in key if k in rows], in_memory=in_memory)
+            else:
+                instance._state.fields_cache[plan.cache_name] = rows.get(key)
 
     @classmethod
-    def parse_includes(cls, instance, fields):
-        for field, nested in fields.items():
-            data = getattr(instance, '__' + field.name)
-            delattr(instance, '__' + field.name)
-            # SQLite doesn't auto parse JSON
+    def parse_includes(cls, instance, plans, lazy=False, report=None, identities=None, in_memory=False):
+        for plan in plans:
+            data = instance.__dict__.pop(plan.annotation_name)
+            path = plan.name
+            # Includes are selected as text, see IncludeJSONField.select_format
             if isinstance(data, util.STR_TYPE):
-                data = util.json.loads(data)
-            cls.parse_nested(instance, field, nested, data)
+                if report is None:
+                    data = util.get_json_loads()(data)
+                else:
+                    start, size = time.perf_counter(), len(data.encode('utf-8'))
+                    data = util.get_json_loads()(data)
+                    report.decoded(path, plan, size, time.perf_counter() - start)
+            if lazy and not plan.to_attr:
+                cls.defer_nested(instance, plan, data, path=path, report=report, identities=identities, in_memory=in_memory)
+            else:
+                cls.parse_nested(instance, plan, data, path=path, report=report, identities=identities, in_memory=in_memory)
+
+    def prepare(self):
+        """Return the (plans, normalized, prefetches) of hydrating the includes of self.queryset, see hydrate."""
+        prefetches = self.queryset._get_prefetches()
+        if prefetches:
+            # Load anything cheaper to prefetch with a batched query, per chunk of .iterator(), rather than JSON aggregation
+            self.queryset = self.queryset._clone()
+            for key, prefetch in prefetches:
+                self.queryset._exclude(key)
+                del self.queryset._includes[key]
+            prefetches = [prefetch for key, prefetch in prefetches]
+
+        plans = [get_plan(tree.field, tree) for tree in self.queryset._includes.values() if not tree.normalize]
+        normalized = [
+            (tree.field, tree, self.queryset._get_related_queryset(tree.field, tree))
+            for tree in self.queryset._includes.values()
+            if tree.normalize
+        ]
+
+        return plans, normalized, prefetches
+
+    def hydrate(self, chunk, plans, normalized, prefetches, report=None, identities=None):
+        """Hydrate the includes of a chunk of instances, their raw data popped from each instance's __dict__."""
+        for instance in chunk:
+            self.parse_includes(instance, plans, lazy=self.queryset._include_lazy, report=report, identities=identities, in_memory=self.queryset._include_in_memory)
+
+        if report is not None:
+            report.send()
+
+        for field, tree, queryset in normalized:
+            self.parse_normalized(chunk, field, tree, queryset, in_memory=self.queryset._include_in_memory)
+
+        if prefetches:
+            prefetch_related_objects(chunk, *prefetches)
+
+    def __iter__(self):
+        self.queryset = self.queryset._get_page()
+        plans, normalized, prefetches = self.prepare()
+        instances = super(IncludeModelIterable, self).__iter__()
+        # Stats are only gathered when someone is listening for them
+        report = signals.IncludeReport(self.queryset.model) if signals.has_listeners(self.queryset.model) else None
+        # {(plan, pk): instance}, shared by every chunk unless memory use is bound by chunk_size
+        identities = {} if self.queryset._include_identity_map else None
+
+        # Hydrate includes a chunk at a time, in step with the fetches of a server side cursor when using .iterator(chunk_size=N).
+        # A chunk is dropped before the next one is fetched so memory use is bound by chunk_size rather than the size of the results.
+        # Otherwise every row is fetched up front anyway, hydrate them in a single batch so normalized rows and prefetches are queried once
+        size = self.chunk_size if self.chunked_fetch else None
+
+        while True:
+            chunk = list(itertools.islice(instances, size))
+            if not chunk:
+                return
+
+            if identities is not None and self.chunked_fetch:
+                identities = {}
+
+            self.hydrate(chunk, plans, normalized, prefetches, report=report, identities=identities)
+
+            for instance in chunk:
+                yield instance
+
+            del chunk, instance
+
+
+class IncludeValuesIterable(ValuesIterable):
+    """Yields a dict per row, like .values(), with includes built straight from their JSON into dicts, see IncludePlan.to_values."""
+
+    named = True
+
+    def get_plans(self):
+        return [get_plan(tree.field, tree) for tree in self.queryset._includes.values()]
+
+    def to_values(self, plan, data):
+        # Includes are selected as text, see IncludeJSONField.select_format
+        if isinstance(data, util.STR_TYPE):
+            data = util.get_json_loads()(data)
+        return plan.to_values(self.queryset.db, data, named=self.named)
+
+    def __iter__(self):
+        self.queryset = self.queryset._get_page()
+        plans = self.get_plans()
+
+        for row in super(IncludeValuesIterable, self).__iter__():
+            for plan in plans:
+                row[plan.name] = self.to_values(plan, row.pop(plan.annotation_name))
+            yield row
+
+
+class IncludeValuesListIterable(IncludeValuesIterable, ValuesListIterable):
+    """Yields a tuple per row, like .values_list(), with includes built into tuples."""
+
+    named = False
 
     def __iter__(self):
-        for instance in super(IncludeModelIterable, self).__iter__():
-            self.parse_includes(instance, self.queryset._includes)
+        self.queryset = self.queryset._get_page()
+        query = self.queryset.query
+        plans = self.get_plans()
+
+        # Fields come back in the order they were asked for, otherwise extra, concrete fields then annotations
+        if self.queryset._fields:
+            names = list(self.queryset._fields)
+        else:
+            names = [*query.extra_select, *query.values_select, *query.annotation_select]
+        indexes = [(names.index(plan.annotation_name), plan) for plan in plans]
+
+        for row in ValuesListIterable.__iter__(self):
+            row = list(row)
+            for i, plan in indexes:
+                row[i] = self.to_values(plan, row[i])
+            yield tuple(row)
 
-            yield instance
+
+class IncludeJSONIterable(FlatValuesListIterable):
+    """Yields the JSON text of every row, see IncludeQuerySet.include_json."""
+
+    def __iter__(self):
+        # Sliced after include_json, see IncludeQuerySet._get_page
+        self.queryset = self.queryset._get_page()
+        return super(IncludeJSONIterable, self).__iter__()
+
+
+class AsyncWorker(object):
+    """A long-lived thread for coroutines to run the queries of a database on, see AsyncWorker.get.
+
+    Django's connections are per thread, anything using the same connection,
+    or server side cursor, has to stay on the same thread. Like a request
+    thread, the worker reuses its connection and closes it between calls
+    once it's unusable or older than CONN_MAX_AGE.
+
+    The worker's connection is not that of the thread awaiting it, queries
+    run outside of any atomic block that thread is in. They can't see its
+    uncommitted writes and aren't rolled back along with it.
+    """
+
+    _lock = threading.Lock()
+    # {database alias: AsyncWorker}
+    _workers = {}
+
+    @classmethod
+    def get(cls, using):
+        with cls._lock:
+            try:
+                return cls._workers[using]
+            except KeyError:
+                worker = cls._workers[using] = cls(using)
+                return worker
+
+    def __init__(self, using):
+        # Only imported once something is run asynchronously, most never will be
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.using = using
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='include-{}'.format(using))
+        # The number of calls in progress, only touched by the worker's thread
+        self.active = 0
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func to run on the worker, returns a concurrent.futures.Future."""
+        # Stats are collected by whoever is waiting on the worker, see signals.collect
+        return self.executor.submit(self._call, signals.get_collectors(), func, args, kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """Queue func to run on the worker, returns an awaitable."""
+        import asyncio
+
+        return asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def _call(self, collectors, func, args, kwargs):
+        with signals.collecting(collectors):
+            return func(*args, **kwargs)
+
+    def enter(self):
+        """Start a call, run on the worker before any of its queries."""
+        if not self.active:
+            # Like the start of a request, see django.db.close_old_connections
+            connections[self.using].close_if_unusable_or_obsolete()
+        self.active += 1
+
+    def exit(self):
+        """End a call, run on the worker after all of its queries."""
+        self.active -= 1
+        # Other calls may still be iterating over a server side cursor
+        if not self.active:
+            connections[self.using].close_if_unusable_or_obsolete()
+
+    async def call(self, func, *args, **kwargs):
+        """Run func on the worker as a call of its own."""
+        def call():
+            self.enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+
+        return await self.run(call)
 
 
 class IncludeQuerySet(models.QuerySet):
 
     def __init__(self, *args, **kwargs):
         super(IncludeQuerySet, self).__init__(*args, **kwargs)
-        self._include_limit = None
         # Needs to be ordered, otherwise there is no way to tell which elements are the child includes
         # {field: {child_field: {}}}
-        self._includes = OrderedDict()
+        self._includes = IncludeTree()
+        self._include_lazy = False
+        self._include_lateral = False
+        self._include_identity_map = False
+        self._include_in_memory = False
+        self._include_paginate = False
         # Not sure why Django didn't make this a class level variable w/e
         self._iterable_class = IncludeModelIterable
 
@@ -102,6 +515,65 @@ class IncludeQuerySet(models.QuerySet):
         If fields are specified, they must be non-hidden relationships.
 
         If select_related(None) is called, clear the list.
+
+        limit_includes caps the number of related objects included per parent.
+        It may be an int, applied to every many-valued field in this call, or a
+        dict of {path: int}, ie {'children': 10, 'children__aliases': 3}.
+
+        only and defer are dicts of {path: [field names]} that behave like
+        QuerySet.only and QuerySet.defer for the objects included at path.
+
+        If lazy is True, included objects are only hydrated once their related
+        manager or descriptor is first used.
+
+        max_elements and max_bytes guard against pathological parents, ie a
+        cat with 200k aliases. Like limit_includes, they may be an int, applied
+        to every many-valued field in this call, or a dict of {path: int}.
+        Rows beyond max_elements are never selected, nor are those past
+        max_bytes of JSON. When the objects of a parent exceed either, overflow
+        decides what happens:
+
+        * "raise", the default, raises IncludeLimitExceeded
+        * "truncate" keeps what fits. The related manager's queryset, or list
+          of a to_attr, is marked with truncated = True
+        * "lazy" leaves the related manager to query for all of them
+
+        Every overflow sends include.signals.include_overflowed.
+
+        If recursive is True, self-referential reverse foreign keys, ie
+        Cat.children, are included along with everything beneath them, up to
+        max_depth levels deep, in a single recursive CTE. The related managers
+        of the deepest objects are left to query for their own children.
+
+        If identity_map is True, related rows included more than once, ie the
+        archetype shared by many cats, are hydrated once and the same instance
+        is shared between their parents. Changing it on one parent changes it
+        on all of them.
+
+        If in_memory is True, simple .filter(), .exclude() and .order_by() calls on
+        the related managers of included objects are answered from the included
+        objects rather than a query, when that's sure to give the same results.
+        See include.memory.
+
+        If paginate is True, a sliced queryset, ie a page, selects the primary
+        keys of its rows with an inner query that has no includes. Includes are
+        only selected by an outer query, for the rows of the page, rather than
+        every row skipped by its offset. Filters that duplicate rows, across
+        many-valued relations without .distinct(), may return any duplicates of
+        the page's rows that fall outside of it.
+
+        If lateral is True, collection includes are compiled as
+        LEFT JOIN LATERAL (...) ON TRUE rather than subqueries in the select
+        list. PostgreSQL only.
+
+        strategy="auto" estimates the fan-out and width of each field and loads
+        those that would make for large JSON aggregations with a batched
+        prefetch instead, see include.strategy.
+
+        If normalize is True, many to many and forward foreign key includes only
+        select the keys of their related rows. The rows are loaded once, by key,
+        or once per chunk of .iterator(), and shared by every parent that
+        references them.
         """
         clone = self._clone()
 
@@ -112,38 +584,552 @@ class IncludeQuerySet(models.QuerySet):
         if self.query.filter_is_sticky:
             clone.query.filter_is_sticky = True
 
-        clone._include_limit = kwargs.pop('limit_includes', None)
-        assert not kwargs, '"limit_includes" is the only accepted kwargs. Eat your heart out 2.7'
+        limits = kwargs.pop('limit_includes', None)
+        only = kwargs.pop('only', None) or {}
+        defer = kwargs.pop('defer', None) or {}
+        clone._include_lazy = kwargs.pop('lazy', clone._include_lazy)
+        clone._include_lateral = kwargs.pop('lateral', clone._include_lateral)
+        clone._include_identity_map = kwargs.pop('identity_map', clone._include_identity_map)
+        clone._include_in_memory = kwargs.pop('in_memory', clone._include_in_memory)
+        clone._include_paginate = kwargs.pop('paginate', clone._include_paginate)
+        load = kwargs.pop('strategy', None)
+        normalize = kwargs.pop('normalize', False)
+        guards = {'max_elements': kwargs.pop('max_elements', None), 'max_bytes': kwargs.pop('max_bytes', None)}
+        overflow = kwargs.pop('overflow', 'raise')
+        recursive = kwargs.pop('recursive', False)
+        max_depth = kwargs.pop('max_depth', None)
+        assert not kwargs, (
+            '"limit_includes", "only", "defer", "lazy", "lateral", "identity_map", "in_memory", "paginate", "strategy", "normalize", '
+            '"max_elements", "max_bytes", "overflow", "recursive" and "max_depth" are the only accepted kwargs. Eat your heart out 2.7'
+        )
+
+        if recursive and not (isinstance(max_depth, int) and max_depth > 0):
+            raise ValueError('Recursive includes need a max_depth of at least 1')
+
+        if overflow not in OVERFLOWS:
+            raise ValueError('Unknown overflow "{}", expected one of {}'.format(overflow, ', '.join('"{}"'.format(o) for o in OVERFLOWS)))
+
+        if load is not None and load not in strategy.STRATEGIES:
+            raise ValueError('Unknown strategy "{}", expected one of {}'.format(load, ', '.join('"{}"'.format(s) for s in strategy.STRATEGIES)))
 
         # Copy the behavior of .select_related(None)
         if fields == (None, ):
-            for field in clone._includes.keys():
-                clone.query.annotations.pop('__{}'.format(field.name), None)
-            clone._includes.clear()
+            clone._clear_includes()
             return clone
 
         # Parse everything the way django handles joins/select related
         # Including multiple child fields ie .include(field1__field2, field1__field3)
         # turns into {field1: {field2: {}, field3: {}}
-        for name in fields:
+        for lookup in fields:
+            if not isinstance(lookup, Include):
+                lookup = Include(lookup)
+
             ctx, model = clone._includes, clone.model
-            for spl in name.split('__'):
-                field = util.get_field(model, spl)
+            names = lookup.path.split('__')
+            for i, spl in enumerate(names):
+                key, field = clone._get_key(ctx, model, spl)
                 if isinstance(field, ForeignObjectRel) and field.is_hidden():
                     raise ValueError('Hidden field "{!r}" has no descriptor and therefore cannot be included'.format(field))
+
+                last = i == len(names) - 1
+                if last and lookup.to_attr is not None:
+                    clone._check_to_attr(lookup, model)
+                    key = IncludeTree.get_key(field, lookup.to_attr)
+
                 model = field.related_model
-                ctx = ctx.setdefault(field, OrderedDict())
+                top, ctx = ctx is clone._includes, ctx.setdefault(key, IncludeTree(field))
+
+                if last and (lookup.queryset is not None or lookup.to_attr is not None):
+                    clone._check_lookup(lookup, field, normalize=top and normalize)
+                    ctx.queryset, ctx.to_attr = lookup.queryset, lookup.to_attr
+
+                if last and recursive:
+                    clone._check_recursive(lookup, field)
+                    ctx.max_depth = max_depth
+
+                if top and load is not None:
+                    ctx.strategy = load
 
-        for field in clone._includes.keys():
-            clone._include(field)
+                if top and normalize:
+                    if not (field.many_to_many or (field.concrete and (field.many_to_one or field.one_to_one))):
+                        raise ValueError('Cannot normalize "{}", only many to many relations and forward foreign keys share related rows'.format(spl))
+                    ctx.normalize = True
+
+                if isinstance(limits, int) and (field.one_to_many or field.many_to_many):
+                    ctx.limit = limits
+
+                for option, guard in guards.items():
+                    if isinstance(guard, int) and (field.one_to_many or field.many_to_many):
+                        clone._set_guard('__'.join(names[:i + 1]), ctx, option, guard, overflow)
+
+        if isinstance(limits, dict):
+            for name, limit in limits.items():
+                field, ctx = clone._get_include(name)
+                if not (field.one_to_many or field.many_to_many):
+                    raise ValueError('Cannot limit "{}", limits only apply to many-valued relationships'.format(name))
+                ctx.limit = limit
+
+        for option, guard in guards.items():
+            if not isinstance(guard, dict):
+                continue
+            for name, value in guard.items():
+                field, ctx = clone._get_include(name)
+                if not (field.one_to_many or field.many_to_many):
+                    raise ValueError('Cannot guard "{}", {} only applies to many-valued relationships'.format(name, option))
+                clone._set_guard(name, ctx, option, value, overflow)
+
+        for tree in clone._includes.walk():
+            if tree.max_depth is not None and (len(tree) or tree.limit is not None or tree.max_elements is not None or tree.max_bytes is not None):
+                raise ValueError('Cannot limit, guard or include beneath "{}", it is included recursively'.format(tree.name))
+
+        # Mirror QuerySet.only/.defer, .only replaces any previous set of fields and .defer adds to it
+        for name, names in only.items():
+            field, ctx = clone._get_include(name)
+            ctx.only, ctx.defer = clone._get_field_names(name, field, names), None
+
+        for name, names in defer.items():
+            field, ctx = clone._get_include(name)
+            ctx.defer = (ctx.defer or frozenset()) | clone._get_field_names(name, field, names)
+
+        for key in clone._includes.keys():
+            clone._include(key)
 
         return clone
 
+    def include_count(self, *fields):
+        """
+        Return a new QuerySet instance that will include the number of objects
+        related to each instance, rather than the objects themselves, as
+        <name>__count. Paths may be nested beneath other includes, ie
+        include_count('posts__comment_set') sets comment_set__count on every
+        included post, and Include objects may filter what is counted and name
+        the attribute it's stored on.
+
+        Counts are selected by correlated subqueries so, unlike
+        .annotate(Count(...)), nothing is grouped by.
+        """
+        return self._include_aggregate('count', fields)
+
+    def include_exists(self, *fields):
+        """
+        Like include_count, but includes whether any related objects exist, as
+        <name>__exists.
+        """
+        return self._include_aggregate('exists', fields)
+
+    async def aiterator(self, chunk_size=2000):
+        """
+        An asynchronous iterator over the results of this queryset, like
+        .iterator(chunk_size).
+
+        Rows are fetched, decoded and hydrated a chunk at a time on a thread of
+        their own, the next chunk is loaded while the current one is consumed,
+        so the event loop is never blocked for longer than it takes to yield a
+        row. The thread, and its connection, are shared by every async call on
+        the same database. Queries run outside of any transaction of the
+        calling thread, see AsyncWorker.
+        """
+        worker = AsyncWorker.get(self.db)
+        iterator = self.iterator(chunk_size=chunk_size)
+
+        def fetch():
+            return list(itertools.islice(iterator, chunk_size))
+
+        # Everything is queued, in order, on the worker. Nothing needs awaiting but the fetches
+        worker.submit(worker.enter)
+        try:
+            pending = worker.run(fetch)
+            while True:
+                chunk = await pending
+                if not chunk:
+                    return
+                pending = worker.run(fetch)
+                for instance in chunk:
+                    yield instance
+        finally:
+            # Queued behind any pending fetch, the cursor is closed on the thread it was opened on. Not awaited,
+            # generators left unfinished are closed as their loop shuts down, when they may never be resumed again
+            worker.submit(iterator.close)
+            worker.submit(worker.exit)
+
+    def __aiter__(self):
+        return self.aiterator()
+
+    async def aget(self, *args, **kwargs):
+        """Like .get, run on a thread of its own, see aiterator."""
+        return await AsyncWorker.get(self.db).call(self.get, *args, **kwargs)
+
+    async def afirst(self):
+        """Like .first, run on a thread of its own, see aiterator."""
+        return await AsyncWorker.get(self.db).call(self.first)
+
+    def include_values(self, *fields, **expressions):
+        """
+        Like .values, but with every include added to each dict, by field name.
+
+        Included objects are built straight from their JSON into dicts of
+        {attname: value} rather than model instances, as a list for many-valued
+        fields or a dict, or None, for single-valued fields. Values are decoded
+        just as they would be for model instances.
+        """
+        fields += tuple(expressions)
+        clone = self._values(*self._get_values_fields(fields), **expressions)
+        clone._iterable_class = IncludeValuesIterable
+        return clone
+
+    def include_values_list(self, *fields):
+        """
+        Like .values_list, but with every include added to the end of each
+        tuple, in the order they were included, as tuples rather than model
+        instances. Included tuples end with whatever is included beneath them.
+        """
+        clone = self._values(*self._get_values_fields(fields))
+        clone._iterable_class = IncludeValuesListIterable
+        return clone
+
+    def include_json(self, *fields, **kwargs):
+        """
+        Return the JSON text of every row, built by the database, without
+        decoding it or hydrating model instances. Meant to be written straight
+        into a response.
+
+        Each row is an object of the given fields, or every concrete field by
+        attname, and every include by field name. Included objects are keyed
+        the same way, see include_values.
+
+        If aggregate is True, the queryset is evaluated and a single JSON array
+        of every row is returned.
+
+        Pages of queryset included with paginate=True only build the JSON of
+        their own rows, sliced before or after include_json.
+        """
+        aggregate = kwargs.pop('aggregate', False)
+        assert not kwargs, '"aggregate" is the only accepted kwarg. Eat your heart out 2.7'
+
+        clone = self._get_page()._chain()
+        pairs = [(name, F(name)) for name in fields or [f.attname for f in self.model._meta.concrete_fields]]
+
+        for key, tree in clone._includes.items():
+            if tree.normalize:
+                raise ValueError('Cannot build JSON of "{}", normalized includes are loaded as model instances'.format(tree.name))
+            decoded = next((t for t in [tree, *tree.walk()] if t.max_elements is not None or t.max_bytes is not None or t.max_depth is not None), None)
+            if decoded is not None:
+                raise ValueError('Cannot build JSON of "{}", guarded and recursive includes are checked and assembled as they are decoded'.format(decoded.name))
+            # Lateral joins are only rendered for includes selected on their own
+            clone._exclude(key)
+            pairs.append((tree.name, IncludeExpression(get_plan(tree.field, tree), keyed=True)))
+
+        clone.query.add_annotation(JSONBuildObject(*pairs, output_field=IncludeJSONField()), '__json', is_summary=False)
+        includes = clone._includes
+        clone = clone.values_list('__json', flat=True)
+        # Already built into the JSON, kept to tell whether a page should be rewritten
+        clone._includes, clone._iterable_class = includes, IncludeJSONIterable
+
+        if not aggregate:
+            return clone
+
+        connection = connections[clone.db]
+
+        try:
+            sql, params = clone.query.get_compiler(connection=connection).as_sql()
+        except EmptyResultSet:
+            return '[]'
+
+        # The rows were cast to text to be selected on their own
+        if connection.vendor == 'sqlite':
+            template = 'SELECT COALESCE(JSON_GROUP_ARRAY(JSON("__rows"."__json")), \'[]\') FROM ({}) "__rows"'
+        else:
+            template = 'SELECT COALESCE(JSON_AGG("__rows"."__json"::json), \'[]\')::text FROM ({}) "__rows"'
+
+        with connection.cursor() as cursor:
+            cursor.execute(template.format(sql), params)
+            return cursor.fetchone()[0]
+
+    # Nothing below hydrates model instances, none of it needs the subqueries, or joins, of includes
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return super(IncludeQuerySet, self._without_includes()).count()
+
+    def exists(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return super(IncludeQuerySet, self._without_includes()).exists()
+
+    def aggregate(self, *args, **kwargs):
+        return super(IncludeQuerySet, self._without_includes()).aggregate(*args, **kwargs)
+
+    def update(self, **kwargs):
+        return super(IncludeQuerySet, self._without_includes()).update(**kwargs)
+    update.alters_data = True
+
+    def delete(self):
+        # The collector loads every deleted object, without its includes
+        return super(IncludeQuerySet, self._without_includes()).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def values(self, *fields, **expressions):
+        return super(IncludeQuerySet, self._without_includes()).values(*fields, **expressions)
+
+    def values_list(self, *fields, **kwargs):
+        return super(IncludeQuerySet, self._without_includes()).values_list(*fields, **kwargs)
+
+    def resolve_expression(self, *args, **kwargs):
+        # Used as a subquery, ie .filter(pk__in=queryset)
+        return super(IncludeQuerySet, self._without_includes()).resolve_expression(*args, **kwargs)
+    resolve_expression.queryset_only = True
+
+    def _get_page(self):
+        """Return a copy of this queryset that selects the rows of its slice by primary key, see include(paginate=True)."""
+        query = self.query
+
+        # DISTINCT selects the columns it's ordered by, which would be more than the primary key
+        if not self._include_paginate or not self._includes or query.can_filter() or query.distinct or query.combinator:
+            return self
+
+        clone = self._chain()
+        clone.query.clear_limits()
+        # Filters are kept, so the outer query joins and orders the rows of the page just like the page itself
+        return clone.filter(pk__in=self.values('pk'))
+
+    def _without_includes(self):
+        clone = self._chain()
+        clone._clear_includes()
+        return clone
+
+    def _clear_includes(self):
+        for key in self._includes.keys():
+            self._exclude(key)
+        self._includes.clear()
+
+    def _get_values_fields(self, fields):
+        for tree in self._includes.values():
+            if tree.normalize:
+                raise ValueError('Cannot build values of "{}", normalized includes are loaded as model instances'.format(tree.name))
+
+        # No fields selects everything, includes already among it
+        if not fields:
+            return fields
+        return fields + tuple('__{}'.format(tree.name) for tree in self._includes.values())
+
     def _clone(self):
         clone = super(IncludeQuerySet, self)._clone()
         clone._includes = copy.deepcopy(self._includes)
+        clone._include_lazy = self._include_lazy
+        clone._include_lateral = self._include_lateral
+        clone._include_identity_map = self._include_identity_map
+        clone._include_in_memory = self._include_in_memory
+        clone._include_paginate = self._include_paginate
         return clone
 
-    def _include(self, field):
+    def _include_aggregate(self, aggregate, fields):
+        clone = self._clone()
+
+        # See .include
+        if self.query.filter_is_sticky:
+            clone.query.filter_is_sticky = True
+
+        for lookup in fields:
+            if not isinstance(lookup, Include):
+                lookup = Include(lookup)
+
+            ctx, model = clone._includes, clone.model
+            names = lookup.path.split('__')
+            # Anything the counted field is beneath is included, as it would be by .include
+            for spl in names[:-1]:
+                key, field = clone._get_key(ctx, model, spl)
+                if isinstance(field, ForeignObjectRel) and field.is_hidden():
+                    raise ValueError('Hidden field "{!r}" has no descriptor and therefore cannot be included'.format(field))
+                model, ctx = field.related_model, ctx.setdefault(key, IncludeTree(field))
+
+            field = util.get_field(model, names[-1])
+            if not (field.one_to_many or field.many_to_many):
+                raise ValueError('Cannot {} "{}", only many-valued relationships can be'.format(aggregate, lookup.path))
+            clone._check_lookup(lookup, field)
+            if lookup.to_attr is not None:
+                clone._check_to_attr(lookup, model)
+
+            tree = IncludeTree(field)
+            tree.aggregate, tree.queryset = aggregate, lookup.queryset
+            tree.to_attr = lookup.to_attr or '{}__{}'.format(names[-1], aggregate)
+            ctx[IncludeTree.get_key(field, tree.to_attr)] = tree
+
+        for key in clone._includes.keys():
+            clone._include(key)
+
+        return clone
+
+    def _get_include(self, name):
+        field, ctx, model = None, self._includes, self.model
+        for spl in name.split('__'):
+            key, field = self._get_key(ctx, model, spl)
+            if key not in ctx:
+                raise ValueError('"{}" has not been included'.format(name))
+            model, ctx = field.related_model, ctx[key]
+        return field, ctx
+
+    def _get_key(self, ctx, model, name):
+        """Return the (key, field) of name beneath ctx, a field of model or the to_attr of an Include."""
+        for key, tree in ctx.items():
+            if tree.to_attr is not None and tree.to_attr == name:
+                return key, tree.field
+        field = util.get_field(model, name)
+        return field, field
+
+    def _check_lookup(self, lookup, field, normalize=False):
+        if normalize:
+            raise ValueError('Cannot normalize "{}", normalized includes cannot be filtered or included to an attribute'.format(lookup.path))
+
+        if lookup.queryset is None:
+            return
+
+        if not (field.one_to_many or field.many_to_many):
+            raise ValueError('Cannot filter "{}", only many-valued includes take a queryset'.format(lookup.path))
+        if lookup.queryset.model is not field.related_model:
+            raise ValueError('Cannot filter "{}" by a queryset of {}, expected {}'.format(lookup.path, lookup.queryset.model.__name__, field.related_model.__name__))
+        if not lookup.queryset.query.can_filter():
+            raise ValueError('Cannot filter "{}" by a sliced queryset, use limit_includes instead'.format(lookup.path))
+        # Rows are aggregated as JSON, which can't be compared to remove duplicates, nor grouped by
+        if lookup.queryset.query.distinct:
+            raise ValueError('Cannot filter "{}" by a distinct queryset, filter by a subquery instead, ie pk__in=queryset.values("pk")'.format(lookup.path))
+        if lookup.queryset.query.annotations:
+            raise ValueError('Cannot filter "{}" by an annotated queryset, included objects only load their fields. Filter by a subquery instead'.format(lookup.path))
+        if lookup.queryset.query.deferred_loading != (frozenset(), True):
+            raise ValueError('Cannot filter "{}" by a queryset with only or defer, use the only and defer options of include instead'.format(lookup.path))
+
+    def _check_to_attr(self, lookup, model):
+        # Like prefetch_related_objects, but descriptors would refuse, or misinterpret, the assignment too
+        try:
+            model._meta.get_field(lookup.to_attr)
+        except FieldDoesNotExist:
+            if not hasattr(model, lookup.to_attr):
+                return
+        raise ValueError('Cannot include "{}" to "{}", it conflicts with a field or attribute of {}'.format(lookup.path, lookup.to_attr, model.__name__))
+
+    def _check_recursive(self, lookup, field):
+        if lookup.queryset is not None or lookup.to_attr is not None:
+            raise ValueError('Cannot include "{}" recursively, recursive includes take no queryset or to_attr'.format(lookup.path))
+        # Only reverse foreign keys make trees, rather than graphs
+        if not (field.one_to_many and field.auto_created and field.related_model._meta.concrete_model is field.model._meta.concrete_model):
+            raise ValueError('Cannot include "{}" recursively, only self-referential reverse foreign keys can be'.format(lookup.path))
+
+    def _set_guard(self, name, tree, option, value, overflow):
+        if tree.normalize:
+            raise ValueError('Cannot guard "{}", normalized includes only select the keys of related rows'.format(name))
+        if overflow == 'lazy' and tree.to_attr is not None:
+            raise ValueError('Cannot fall back to a query for "{}", it is included to an attribute'.format(name))
+        setattr(tree, option, value)
+        tree.overflow = overflow
+
+    def _get_field_names(self, name, field, names):
+        if isinstance(names, util.STR_TYPE):
+            names = (names, )
+        for fname in names:
+            if not getattr(field.related_model._meta.get_field(fname), 'concrete', False):
+                raise ValueError('Cannot only/defer "{}" on "{}", it is not a concrete field'.format(fname, name))
+        return frozenset(names)
+
+    def _get_prefetches(self):
+        """Return a list of (field, Prefetch) of the top level includes that are cheaper to prefetch than aggregate."""
+        return [
+            (key, self._get_prefetch(tree.field, tree))
+            for key, tree in self._includes.items()
+            if tree.strategy == 'auto' and not tree.normalize and strategy.should_prefetch(tree.field, tree, self.db)
+        ]
+
+    def _get_prefetch(self, field, tree):
+        # Anything included beneath field gets the same choice, relative to the prefetched queryset
+        tree = copy.deepcopy(tree)
+        for child_tree in tree.values():
+            child_tree.strategy = 'auto'
+
+        return Prefetch(get_plan(field, tree).accessor_name, queryset=self._get_related_queryset(field, tree))
+
+    def _get_related_queryset(self, field, tree):
+        """Return a queryset of the related model of field including everything beneath it in tree."""
+        queryset = field.related_model.objects.all()
+
+        if tree and not hasattr(queryset, 'include'):
+            raise ValueError('Cannot include beneath "{}", {} does not have an IncludeManager'.format(field.name, field.related_model.__name__))
+
+        if tree.only is not None:
+            queryset = queryset.only(*tree.only)
+        if tree.defer is not None:
+            queryset = queryset.defer(*tree.defer)
+
+        if tree:
+            queryset._includes = copy.deepcopy(tree)
+            queryset._include_lazy = self._include_lazy
+            queryset._include_lateral = self._include_lateral
+            queryset._include_identity_map = self._include_identity_map
+            queryset._include_in_memory = self._include_in_memory
+            queryset._include_paginate = self._include_paginate
+            for child in queryset._includes.keys():
+                queryset._include(child)
+
+        return queryset
+
+    def _include(self, key):
         self.query.get_initial_alias()
-        self.query.add_annotation(IncludeExpression(field, self._includes[field]), '__{}'.format(field.name), is_summary=False)
+        self._exclude(key)
+        tree = self._includes[key]
+        field = tree.field
+
+        if tree.normalize:
+            if not field.many_to_many:
+                # Already selected, as the foreign key itself
+                return
+            # Only the keys of the related rows are included, in order and limited
+            keys = IncludeTree(field)
+            keys.limit, keys.only = tree.limit, frozenset([field.related_model._meta.pk.name])
+            tree = keys
+
+        expression = IncludeExpression(get_plan(field, tree), lateral=self._include_lateral)
+        self.query.add_annotation(expression, '__{}'.format(tree.name), is_summary=False)
+
+    def _exclude(self, key):
+        expression = self.query.annotations.pop('__{}'.format(self._includes[key].name), None)
+        if expression is not None:
+            expression.unref_joins(self.query)
+
+
+def include_objects(instances, *fields, **kwargs):
+    """
+    Include fields onto instances that have already been loaded, ie from a
+    cache or .get(), with a single query. Like prefetch_related_objects, but
+    for .include. kwargs are those of IncludeQuerySet.include.
+
+    Every instance must be of the same model. Unsaved instances, and those
+    whose rows no longer exist, are left as they are.
+    """
+    instances = [instance for instance in instances if instance.pk is not None]
+    if not instances or not fields:
+        return
+
+    model = type(instances[0])
+    if any(type(instance)._meta.concrete_model is not model._meta.concrete_model for instance in instances):
+        raise ValueError('Cannot include onto instances of different models')
+
+    iterable = IncludeModelIterable(IncludeQuerySet(model=model, using=instances[0]._state.db).include(*fields, **kwargs))
+    plans, normalized, prefetches = iterable.prepare()
+    queryset = iterable.queryset
+
+    # Only the includes are selected, by primary key. Normalized forward foreign keys select nothing at all
+    names = [name for name in ('__{}'.format(tree.name) for tree in queryset._includes.values()) if name in queryset.query.annotations]
+
+    if names:
+        values = queryset.filter(pk__in={instance.pk for instance in instances})._values('pk', *names)
+        values._iterable_class = ValuesListIterable
+        rows = {pk: datas for pk, *datas in values}
+
+        instances = [instance for instance in instances if instance.pk in rows]
+        for instance in instances:
+            # Where IncludeModelIterable.parse_includes expects to find them
+            instance.__dict__.update(zip(names, rows[instance.pk]))
+
+    report = signals.IncludeReport(model) if signals.has_listeners(model) else None
+    identities = {} if queryset._include_identity_map else None
+
+    iterable.hydrate(instances, plans, normalized, prefetches, report=report, identities=identities)
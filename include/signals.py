@@ -0,0 +1,134 @@
+import contextlib
+import threading
+from collections import OrderedDict
+
+from django.dispatch import Signal
+
+
+# All signals are sent with the model being queried as the sender and the
+# path of the include, ie "children__aliases", relative to it.
+
+# Sent when a top level include is rendered to SQL.
+# Arguments: path, plan, duration and cached, whether the SQL of the plan was reused
+include_compiled = Signal()
+
+# Sent once a top level include has been decoded from JSON.
+# Arguments: path, plan, bytes, the size of the JSON, and duration
+include_decoded = Signal()
+
+# Sent once the objects included at a path have been hydrated.
+# Arguments: path, plan, rows, the number of objects hydrated, and duration.
+# The duration of a path includes hydrating the paths beneath it
+include_hydrated = Signal()
+
+# Sent every time the objects included at a path for a single parent exceed its max_elements or max_bytes.
+# Arguments: path, plan, instance, the parent, and reason, "elements" or "bytes". Sent before plan.overflow is applied
+include_overflowed = Signal()
+
+SIGNALS = (include_compiled, include_decoded, include_hydrated, include_overflowed)
+
+
+def has_listeners(sender):
+    return any(signal.has_listeners(sender) for signal in SIGNALS)
+
+
+class IncludeReport(object):
+    """Totals the stats of hydrating a batch of objects to send them once per path, rather than once per object."""
+
+    def __init__(self, sender):
+        self.sender = sender
+        # {path: [plan, bytes, decode time, rows, hydrate time]}
+        self.paths = OrderedDict()
+
+    def get(self, path, plan):
+        try:
+            return self.paths[path]
+        except KeyError:
+            stats = self.paths[path] = [plan, None, 0.0, None, 0.0]
+            return stats
+
+    def decoded(self, path, plan, size, duration):
+        stats = self.get(path, plan)
+        stats[1] = (stats[1] or 0) + size
+        stats[2] += duration
+
+    def hydrated(self, path, plan, rows, duration):
+        stats = self.get(path, plan)
+        stats[3] = (stats[3] or 0) + rows
+        stats[4] += duration
+
+    def overflowed(self, path, plan, instance, reason):
+        # Every hit is sent as it happens, raising may stop the rest of the batch
+        include_overflowed.send(sender=self.sender, path=path, plan=plan, instance=instance, reason=reason)
+
+    def send(self):
+        for path, (plan, size, decode_time, rows, hydrate_time) in self.paths.items():
+            if size is not None:
+                include_decoded.send(sender=self.sender, path=path, plan=plan, bytes=size, duration=decode_time)
+            # Lazy includes are decoded up front but hydrated on access
+            if rows is not None:
+                include_hydrated.send(sender=self.sender, path=path, plan=plan, rows=rows, duration=hydrate_time)
+        self.paths.clear()
+
+
+_local = threading.local()
+
+
+def get_collectors():
+    """Return the tokens of the collect blocks this thread is in, see collecting."""
+    return getattr(_local, 'collectors', frozenset())
+
+
+@contextlib.contextmanager
+def collecting(collectors):
+    """Collect into the collect blocks of another thread, from get_collectors, ie when running queries on its behalf."""
+    previous = get_collectors()
+    _local.collectors = previous | collectors
+    try:
+        yield
+    finally:
+        _local.collectors = previous
+
+
+@contextlib.contextmanager
+def collect(sender=None):
+    """Collect the stats of every include evaluated by this thread, optionally only for querysets of sender.
+
+    Includes evaluated on behalf of this thread, by aiterator, aget and afirst,
+    are collected as well.
+
+    Yields a dict of {(model, path): {stat: value}} with the keys compile_time,
+    bytes, decode_time, rows and hydrate_time. Times are in seconds.
+
+        with collect() as stats:
+            list(Cat.objects.include('children__aliases'))
+        stats[(Cat, 'children__aliases')]['rows']
+    """
+    stats = {}
+    token = object()
+
+    def receiver(key, value):
+        def receive(sender, path, duration, **kwargs):
+            if token not in get_collectors():
+                return
+            path_stats = stats.setdefault((sender, path), {'compile_time': 0.0, 'bytes': 0, 'decode_time': 0.0, 'rows': 0, 'hydrate_time': 0.0})
+            path_stats[key] += duration
+            if value:
+                path_stats[value] += kwargs[value]
+        return receive
+
+    receivers = (
+        (include_compiled, receiver('compile_time', None)),
+        (include_decoded, receiver('decode_time', 'bytes')),
+        (include_hydrated, receiver('hydrate_time', 'rows')),
+    )
+
+    for signal, receive in receivers:
+        signal.connect(receive, sender=sender, weak=False)
+
+    try:
+        with collecting(frozenset([token])):
+            yield stats
+    finally:
+        for signal, receive in receivers:
+            signal.disconnect(receive, sender=sender)
@@ -0,0 +1,158 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericRelation
+from django.db import connections
+
+
+STRATEGIES = ('json', 'auto')
+
+Estimate = collections.namedtuple('Estimate', ('fanout', 'width'))
+
+# Rows sampled when the planner has no statistics for a table, ie it has never been analyzed
+SAMPLE_SIZE = 10000
+
+# The width, in bytes, assumed of every column when it can't be measured
+COLUMN_WIDTH = 16
+
+
+class _EstimateCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {key: (expires, estimate)}
+        self._estimates = {}
+
+    def get(self, key):
+        with self._lock:
+            expires, estimate = self._estimates.get(key, (0, None))
+        if expires < time.monotonic():
+            return None
+        return estimate
+
+    def set(self, key, estimate):
+        with self._lock:
+            self._estimates[key] = (time.monotonic() + getattr(settings, 'INCLUDE_AUTO_STATS_TTL', 300), estimate)
+
+    def clear(self):
+        with self._lock:
+            self._estimates.clear()
+
+
+estimates = _EstimateCache()
+
+
+def get_counted(field):
+    """Return the (table, column) counting the number of objects included per parent, None for single-valued fields."""
+    if field.many_to_one or field.one_to_one:
+        return None
+    if isinstance(field, GenericRelation):
+        return field.related_model._meta.db_table, field.related_model._meta.get_field(field.object_id_field_name).column
+    if field.many_to_many and field.auto_created:
+        return field.through._meta.db_table, field.field.m2m_reverse_name()
+    if field.many_to_many:
+        return field.remote_field.through._meta.db_table, field.m2m_column_name()
+    return field.related_model._meta.db_table, field.field.column
+
+
+def get_stats(cursor, connection, table, column):
+    # Postgres' planner statistics, as of the last ANALYZE
+    cursor.execute('''
+        SELECT c.reltuples, s.n_distinct, s.null_frac, (SELECT SUM(w.avg_width) FROM pg_stats w WHERE w.schemaname = n.nspname AND w.tablename = c.relname)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = %s
+        WHERE c.oid = %s::regclass
+    ''', [column, connection.ops.quote_name(table)])
+    row = cursor.fetchone()
+
+    if row is None or row[0] <= 0 or row[1] is None or row[3] is None:
+        return None
+
+    reltuples, n_distinct, null_frac, width = row
+    # Negative values of n_distinct are the ratio of distinct values to rows, NULLs included
+    distinct = -n_distinct * reltuples if n_distinct < 0 else n_distinct
+    # Rows with a NULL key belong to no parent, like those skipped by sample_stats
+    rows = reltuples * (1 - null_frac)
+
+    return Estimate(rows / max(distinct, 1), width)
+
+
+def sample_stats(cursor, connection, table, column, model):
+    quote = connection.ops.quote_name
+    cursor.execute('SELECT COUNT(*), COUNT(DISTINCT {column}) FROM (SELECT {column} FROM {table} WHERE {column} IS NOT NULL LIMIT {limit}) sample'.format(
+        table=quote(table),
+        column=quote(column),
+        limit=SAMPLE_SIZE,
+    ))
+    count, distinct = cursor.fetchone()
+
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT AVG(pg_column_size(sample.*)) FROM (SELECT * FROM {table} LIMIT 100) sample'.format(table=quote(model._meta.db_table)))
+        width = cursor.fetchone()[0]
+    else:
+        width = None
+
+    return Estimate(count / max(distinct, 1), float(width or COLUMN_WIDTH * len(model._meta.concrete_fields)))
+
+
+def estimate(field, using):
+    """Estimate the number of objects included per parent through field and their width in bytes."""
+    key = (using, field.model, field.name)
+
+    cached = estimates.get(key)
+    if cached is not None:
+        return cached
+
+    connection = connections[using]
+    counted = get_counted(field)
+
+    with connection.cursor() as cursor:
+        if counted is None:
+            table, column = field.related_model._meta.db_table, field.related_model._meta.pk.column
+        else:
+            table, column = counted
+
+        result = get_stats(cursor, connection, table, column) if connection.vendor == 'postgresql' else None
+        if result is None:
+            result = sample_stats(cursor, connection, table, column, field.related_model)
+
+        if counted is None:
+            result = Estimate(1.0, result.width)
+        elif counted[0] != field.related_model._meta.db_table:
+            # The fan-out of many to many relations comes from the through table, the width from the related table
+            result = Estimate(result.fanout, estimate_width(cursor, connection, field.related_model))
+
+    estimates.set(key, result)
+    return result
+
+
+def estimate_width(cursor, connection, model):
+    pk = model._meta.pk.column
+    result = get_stats(cursor, connection, model._meta.db_table, pk) if connection.vendor == 'postgresql' else None
+    if result is None:
+        result = sample_stats(cursor, connection, model._meta.db_table, pk, model)
+    return result.width
+
+
+def should_prefetch(field, tree, using):
+    """Decide whether field is cheaper to load with a batched prefetch than JSON aggregation.
+
+    Limits, projections, guards, recursion and Include objects are only supported by JSON aggregation, as are
+    nested includes of models without an IncludeManager.
+    """
+    if tree.limit is not None or tree.only is not None or tree.defer is not None or tree.queryset is not None or tree.to_attr is not None:
+        return False
+
+    if tree.max_elements is not None or tree.max_bytes is not None or tree.max_depth is not None:
+        return False
+
+    if tree and not hasattr(field.related_model.objects.all(), 'include'):
+        return False
+
+    fanout, width = estimate(field, using)
+
+    # Every parent carries a copy of all its related rows, as JSON, when aggregating
+    return fanout * width > getattr(settings, 'INCLUDE_AUTO_MAX_BYTES', 8192)
@@ -1,13 +1,11 @@
+import decimal
+import importlib
+import uuid
+
+from django.conf import settings
 from django.db.models import FieldDoesNotExist
 from django.utils import dateparse
-from psycopg2 import extras
-
-try:
-    import ujson as json
-
-    extras.register_default_json(loads=json.loads)
-except ImportError:
-    import json  # noqa
+from django.utils.module_loading import import_string
 
 
 try:
@@ -21,6 +19,42 @@ except NameError:
     STR_TYPE = str
 
 
+# Tried in order when INCLUDE_JSON_DECODER is not set
+JSON_DECODERS = ('orjson', 'ujson', 'json')
+
+_json_loads = {}
+
+
+def get_json_loads():
+    """Return the loads function used to decode included JSON.
+
+    INCLUDE_JSON_DECODER may be "orjson", "ujson", "json" or the dotted path to
+    a loads function. By default the fastest installed library is used.
+    Decoders are imported on first use.
+    """
+    name = getattr(settings, 'INCLUDE_JSON_DECODER', None)
+
+    try:
+        return _json_loads[name]
+    except KeyError:
+        pass
+
+    if name is None:
+        for module in JSON_DECODERS:
+            try:
+                loads = importlib.import_module(module).loads
+                break
+            except ImportError:
+                continue
+    elif name in JSON_DECODERS:
+        loads = importlib.import_module(name).loads
+    else:
+        loads = import_string(name)
+
+    _json_loads[name] = loads
+    return loads
+
+
 def parse_datetime(s):
     if not s:
         return s
@@ -31,6 +65,45 @@ def parse_datetime(s):
     return dateparse.parse_datetime(s)
 
 
+def parse_bytea(s):
+    # Postgres serializes bytea as hex prefixed with \x
+    return memoryview(bytes.fromhex(s[2:]))
+
+
+# JSON only has strings and numbers, convert values back into the types the database driver would have given us.
+# Decimals are sent over as strings as to not lose precision, see IncludeExpressionConstructor.build_row
+JSON_CONVERTERS = {
+    'BinaryField': parse_bytea,
+    'DateField': dateparse.parse_date,
+    'DateTimeField': parse_datetime,
+    'DecimalField': decimal.Decimal,
+    'DurationField': dateparse.parse_duration,
+    'TimeField': dateparse.parse_time,
+    'UUIDField': uuid.UUID,
+}
+
+
+def get_internal_type(field):
+    # Foreign keys are stored as whatever they point to
+    while field.is_relation:
+        field = field.target_field
+    return field.get_internal_type()
+
+
+def get_concrete_fields(model, only=None, defer=None):
+    """Return the concrete fields of model that are loaded given .only/.defer style field names.
+
+    Just like QuerySet.only, the primary key is always loaded.
+    """
+    if not only and not defer:
+        return model._meta.concrete_fields
+
+    return tuple(
+        f for f in model._meta.concrete_fields
+        if f.primary_key or ((not only or f.name in only or f.attname in only) and not (defer and (f.name in defer or f.attname in defer)))
+    )
+
+
 def get_field(model, fieldname):
     try:
         return model._meta.get_field(fieldname)
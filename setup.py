@@ -39,25 +39,25 @@ setup(
     packages=[
         'include',
     ],
+    python_requires='>=3.6',
     keywords=('django', 'postgres', 'sql', 'optimization', 'performance'),
     install_requires=[
         'psycopg2',
     ],
     extras_require={
-        'faster': ['ujson', 'ciso8601']
+        'faster': ['orjson', 'ciso8601']
     },
     classifiers=[
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Framework :: Django',
-        'Framework :: Django :: 1.9',
-        'Framework :: Django :: 1.10',
-        'Framework :: Django :: 1.11',
+        'Framework :: Django :: 2.0',
+        'Framework :: Django :: 2.1',
+        'Framework :: Django :: 2.2',
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
         'Topic :: Internet :: WWW/HTTP',
@@ -46,3 +46,20 @@ def readme(ctx, browse=False):
     ctx.run("rst2html.py README.rst > README.html")
     if browse:
         webbrowser.open_new_tab('README.html')
+
+
+@task
+def benchmark(ctx, save=False, compare=False, fail='mean:10%'):
+    """Run the benchmarks.
+
+    --save stores the results as a baseline in .benchmarks/, --compare
+    compares against the latest baseline and fails on regressions beyond fail.
+    """
+    import pytest
+    args = ['--benchmark-only', '-o', 'addopts=', 'tests/test_benchmarks.py']
+    if save:
+        args.append('--benchmark-autosave')
+    if compare:
+        args.extend(['--benchmark-compare', '--benchmark-compare-fail={}'.format(fail)])
+    retcode = pytest.main(args)
+    sys.exit(retcode)
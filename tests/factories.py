@@ -1,7 +1,10 @@
+import datetime
+import decimal
+
 import factory
 from factory.django import DjangoModelFactory
 
-from tests.models import Cat, Alias, Archetype, Post, Comment, Author
+from tests.models import Cat, Alias, Archetype, Post, Comment, Author, Checkup
 
 
 class AliasFactory(DjangoModelFactory):
@@ -46,3 +49,17 @@ class CommentFactory(DjangoModelFactory):
 
     class Meta:
         model = Comment
+
+
+class CheckupFactory(DjangoModelFactory):
+    cat = factory.SubFactory(CatFactory)
+    weight = decimal.Decimal('4.1234567891')
+    date = factory.Faker('date_object')
+    time = factory.Faker('time_object')
+    started = factory.Faker('date_time', tzinfo=datetime.timezone.utc)
+    duration = datetime.timedelta(days=1, hours=2, microseconds=30)
+    xray = b'\x00\x01meow'
+    notes = ['healthy', 'fluffy']
+
+    class Meta:
+        model = Checkup
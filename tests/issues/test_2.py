@@ -1,5 +1,7 @@
 import pytest
 
+from include import Include
+
 from tests import models
 from tests import factories
 
@@ -29,3 +31,32 @@ class TestIssue2:
 
                 with django_assert_num_queries(1):
                     assert len(parent.children.all().filter(archetype=a2)) == 5
+
+    def test_filtered_include(self, django_assert_num_queries):
+        a1, a2 = factories.ArchetypeFactory(), factories.ArchetypeFactory()
+        parent = factories.CatFactory()
+
+        for i in range(10):
+            factories.CatFactory(archetype=a1 if i % 2 == 0 else a2, parent=parent)
+
+        with django_assert_num_queries(1):
+            parent = models.Cat.objects.include(
+                'children',
+                Include('children', queryset=models.Cat.objects.filter(archetype=a1), to_attr='a1_children'),
+            ).get(pk=parent.pk)
+
+            assert len(parent.children.all()) == 10
+            assert len(parent.a1_children) == 5
+
+    def test_in_memory(self, django_assert_num_queries):
+        a1, a2 = factories.ArchetypeFactory(), factories.ArchetypeFactory()
+        parent = factories.CatFactory()
+
+        for i in range(10):
+            factories.CatFactory(archetype=a1 if i % 2 == 0 else a2, parent=parent)
+
+        parent = models.Cat.objects.include('children', in_memory=True).get(pk=parent.pk)
+
+        with django_assert_num_queries(0):
+            assert len(parent.children.filter(archetype=a1)) == 5
+            assert len(parent.children.all().filter(archetype=a2)) == 5
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+import tests.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tests', '0004_author_comment_post'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkup',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('weight', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('date', models.DateField()),
+                ('time', models.TimeField()),
+                ('started', models.DateTimeField()),
+                ('duration', models.DurationField()),
+                ('xray', models.BinaryField(null=True)),
+                ('notes', tests.models.CommaSeparatedField(null=True)),
+                ('cat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkups', to='tests.Cat')),
+                ('follow_up', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='follow_ups', to='tests.Checkup')),
+            ],
+        ),
+    ]
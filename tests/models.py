@@ -1,3 +1,5 @@
+import uuid
+
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
@@ -73,3 +75,32 @@ class Comment(models.Model):
     author = models.ForeignKey(Author, on_delete=models.CASCADE)
 
     objects = IncludeManager()
+
+
+class CommaSeparatedField(models.TextField):
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return value.split(',')
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return ','.join(value)
+
+
+class Checkup(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    cat = models.ForeignKey(Cat, on_delete=models.CASCADE, related_name='checkups')
+    follow_up = models.ForeignKey('Checkup', on_delete=models.CASCADE, null=True, related_name='follow_ups')
+
+    weight = models.DecimalField(max_digits=20, decimal_places=10)
+    date = models.DateField()
+    time = models.TimeField()
+    started = models.DateTimeField()
+    duration = models.DurationField()
+    xray = models.BinaryField(null=True)
+    notes = CommaSeparatedField(null=True)
+
+    objects = IncludeManager()
@@ -0,0 +1,227 @@
+"""Benchmarks of .include against the equivalent prefetch_related/select_related.
+
+Skipped by default, run them with `inv benchmark`. Every benchmark records
+the following in its extra_info, measured over a single, separate run:
+
+* queries: the number of queries executed
+* db_time: seconds spent executing queries and fetching their rows
+* bytes: the size of the rows fetched, in their text representation
+* decode_time: seconds spent decoding included JSON
+* hydrate_time: the remainder, seconds spent building model instances
+* wall_time: seconds spent overall
+* peak_memory: peak bytes allocated by Python while running
+"""
+import time
+import tracemalloc
+
+import pytest
+
+from django.db import connection
+from django.db.models import Prefetch
+
+from include import util
+
+from tests import models
+from tests import factories
+
+
+def make_cats(count, fanout=0, depth=0):
+    archetype = factories.ArchetypeFactory()
+    roots = level = models.Cat.objects.bulk_create(factories.CatFactory.build_batch(count, archetype=archetype))
+
+    for _ in range(depth):
+        level = models.Cat.objects.bulk_create([
+            child
+            for parent in level
+            for child in factories.CatFactory.build_batch(fanout, archetype=archetype, parent=parent)
+        ])
+
+    return roots
+
+
+def walk(instances, path):
+    # Touch every related object so lazily loaded relations are paid for too
+    for name in path.split('__'):
+        related = []
+        for instance in instances:
+            value = instance[name] if isinstance(instance, dict) else getattr(instance, name)
+            if isinstance(value, list):
+                related.extend(value)
+            elif hasattr(value, 'all'):
+                related.extend(value.all())
+            elif value is not None:
+                related.append(value)
+        instances = related
+    return instances
+
+
+def measure(queryset, path):
+    stats = {'queries': 0, 'db_time': 0.0, 'bytes': 0, 'decode_time': 0.0}
+    executed = []
+
+    def execute(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats['db_time'] += time.perf_counter() - start
+            stats['queries'] += 1
+            executed.append((sql, params))
+
+    get_json_loads = util.get_json_loads
+
+    def timed_json_loads():
+        loads = get_json_loads()
+
+        def timed(s):
+            start = time.perf_counter()
+            try:
+                return loads(s)
+            finally:
+                stats['decode_time'] += time.perf_counter() - start
+        return timed
+
+    util.get_json_loads = timed_json_loads
+    try:
+        with connection.execute_wrapper(execute):
+            start = time.perf_counter()
+            walk(list(queryset.all()), path)
+            stats['wall_time'] = time.perf_counter() - start
+    finally:
+        util.get_json_loads = get_json_loads
+
+    stats['hydrate_time'] = stats['wall_time'] - stats['db_time'] - stats['decode_time']
+
+    # Tracing allocations slows everything down, so memory gets a run of its own
+    tracemalloc.start()
+    try:
+        walk(list(queryset.all()), path)
+        stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    with connection.cursor() as cursor:
+        for sql, params in executed:
+            cursor.execute('SELECT COALESCE(SUM(OCTET_LENGTH(__row::text)), 0) FROM ({}) __row'.format(sql), params)
+            stats['bytes'] += cursor.fetchone()[0]
+
+    return stats
+
+
+def run(benchmark, group, queryset, path):
+    benchmark.group = group
+    benchmark.extra_info.update(measure(queryset, path))
+    benchmark(lambda: walk(list(queryset.all()), path))
+
+
+STRATEGIES = ('include', 'prefetch_related')
+
+
+@pytest.mark.django_db
+class TestBenchmarks:
+
+    @pytest.mark.parametrize('strategy', STRATEGIES)
+    @pytest.mark.parametrize('fanout', [1, 10, 50])
+    def test_fanout(self, benchmark, strategy, fanout):
+        make_cats(20, fanout=fanout, depth=1)
+        queryset = getattr(models.Cat.objects.filter(parent__isnull=True), strategy)('children')
+
+        run(benchmark, 'fanout-{}'.format(fanout), queryset, 'children')
+
+    @pytest.mark.parametrize('strategy', STRATEGIES + ('recursive', ))
+    @pytest.mark.parametrize('depth', [1, 2, 3])
+    def test_depth(self, benchmark, strategy, depth):
+        make_cats(10, fanout=5, depth=depth)
+        path = '__'.join(['children'] * depth)
+        if strategy == 'recursive':
+            queryset = models.Cat.objects.filter(parent__isnull=True).include('children', recursive=True, max_depth=depth)
+        else:
+            queryset = getattr(models.Cat.objects.filter(parent__isnull=True), strategy)(path)
+
+        run(benchmark, 'depth-{}'.format(depth), queryset, path)
+
+    @pytest.mark.parametrize('strategy', STRATEGIES + ('lateral', ))
+    @pytest.mark.parametrize('count', [10, 100, 1000])
+    def test_rows(self, benchmark, strategy, count):
+        make_cats(count, fanout=5, depth=1)
+        if strategy == 'lateral':
+            queryset = models.Cat.objects.filter(parent__isnull=True).include('children', lateral=True)
+        else:
+            queryset = getattr(models.Cat.objects.filter(parent__isnull=True), strategy)('children')
+
+        run(benchmark, 'rows-{}'.format(count), queryset, 'children')
+
+    @pytest.mark.parametrize('strategy', STRATEGIES)
+    @pytest.mark.parametrize('width', ['narrow', 'wide'])
+    def test_width(self, benchmark, strategy, width):
+        for cat in make_cats(20):
+            factories.CheckupFactory.create_batch(10, cat=cat)
+
+        if strategy == 'include' and width == 'narrow':
+            queryset = models.Cat.objects.include('checkups', only={'checkups': ['cat']})
+        elif strategy == 'include':
+            queryset = models.Cat.objects.include('checkups')
+        elif width == 'narrow':
+            queryset = models.Cat.objects.prefetch_related(Prefetch('checkups', queryset=models.Checkup.objects.only('cat')))
+        else:
+            queryset = models.Cat.objects.prefetch_related('checkups')
+
+        run(benchmark, 'width-{}'.format(width), queryset, 'checkups')
+
+    @pytest.mark.parametrize('strategy', ('include', 'select_related'))
+    def test_single_valued(self, benchmark, strategy):
+        for cat in make_cats(100):
+            factories.CheckupFactory(cat=cat)
+
+        queryset = getattr(models.Checkup.objects.all(), strategy)('cat__archetype')
+
+        run(benchmark, 'single-valued', queryset, 'cat__archetype')
+
+    @pytest.mark.parametrize('strategy', STRATEGIES)
+    def test_many_to_many(self, benchmark, strategy):
+        authors = factories.AuthorFactory.create_batch(10)
+        for post in factories.PostFactory.create_batch(50):
+            post.authors.set(authors)
+            factories.CommentFactory.create_batch(5, post=post, author=authors[0])
+
+        queryset = getattr(models.Post.objects.all(), strategy)('authors', 'comment_set')
+
+        run(benchmark, 'many-to-many', queryset, 'authors')
+
+    @pytest.mark.parametrize('strategy', STRATEGIES)
+    def test_through(self, benchmark, strategy):
+        organizations = [models.Organization.objects.create(title=str(i)) for i in range(5)]
+        models.Membership.objects.bulk_create([
+            models.Membership(member=cat, organization=organization)
+            for cat in make_cats(50)
+            for organization in organizations
+        ])
+
+        queryset = getattr(models.Cat.objects.all(), strategy)('organizations')
+
+        run(benchmark, 'through', queryset, 'organizations')
+
+    @pytest.mark.parametrize('strategy', STRATEGIES)
+    def test_generic(self, benchmark, strategy):
+        for cat in make_cats(50):
+            factories.AliasFactory.create_batch(3, describes=cat)
+
+        queryset = getattr(models.Cat.objects.all(), strategy)('aliases')
+
+        run(benchmark, 'generic', queryset, 'aliases')
+
+    @pytest.mark.parametrize('strategy', ('include', 'include_values'))
+    def test_values(self, benchmark, strategy):
+        make_cats(100, fanout=10, depth=1)
+        queryset = models.Cat.objects.filter(parent__isnull=True).include('children')
+        if strategy == 'include_values':
+            queryset = queryset.include_values()
+
+        run(benchmark, 'values', queryset, 'children')
+
+    @pytest.mark.parametrize('strategy', ('include', 'paginate'))
+    def test_page(self, benchmark, strategy):
+        make_cats(1000, fanout=5, depth=1)
+        queryset = models.Cat.objects.filter(parent__isnull=True).order_by('name').include('children', paginate=strategy == 'paginate')
+
+        run(benchmark, 'page', queryset[900:950], 'children')
@@ -1,6 +1,19 @@
+import asyncio
+import decimal
+import gc
+import json
+import pickle
+import tracemalloc
+
 import pytest
 
+from django.db import connection
+from django.db import connections
+from django.db.backends.signals import connection_created
 from django.db.models import Count
+from django.db.models import prefetch_related_objects
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 try:
     from django.db.models import OuterRef
     from django.db.models import Subquery
@@ -9,10 +22,47 @@ except ImportError:  # Django < 1.11
 else:
     HAS_SUBQUERIES = True
 
+from include import Include
+from include import IncludeLimitExceeded
+from include import include_objects
+from include import plan as include_plan
+from include import signals
+from include import strategy
+from include.expressions import IncludeExpression
+from include.query import AsyncWorker
+
 from tests import models
 from tests import factories
 
 
+DECODED = []
+
+
+def related_pks(instance, path):
+    # The pks of everything at path beneath instance, in order
+    related = [instance]
+    for name in path.split('__'):
+        values = [getattr(obj, name, None) for obj in related]
+        related = [value for obj in values if obj is not None for value in (obj.all() if hasattr(obj, 'all') else [obj])]
+    return [obj.pk for obj in related]
+
+
+def run_async(coroutine):
+    # asyncio.run is Python 3.7+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        # Close async generators left unfinished, ie by breaking out of async for, as asyncio.run would
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def counting_loads(s):
+    DECODED.append(s)
+    return json.loads(s)
+
+
 @pytest.mark.django_db
 class TestQuerySet:
 
@@ -307,9 +357,84 @@ class TestOneToOne:
                 assert cat.emergency_contact_for != cat.id
 
 
-@pytest.mark.skip
+@pytest.mark.django_db
 class TestForeignKey:
-    pass
+
+    def test_joined(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        child = factories.CatFactory(parent=parent)
+
+        sql = str(models.Cat.objects.include('archetype', 'parent').query)
+        assert sql.count('SELECT') == 1
+        assert 'INNER JOIN "tests_archetype"' in sql
+        assert 'LEFT OUTER JOIN "tests_cat"' in sql
+
+        with django_assert_num_queries(1):
+            cats = {cat.pk: cat for cat in models.Cat.objects.include('archetype', 'parent')}
+            assert cats[parent.pk].parent is None
+            assert cats[child.pk].parent.pk == parent.pk
+            assert cats[child.pk].archetype.pk == child.archetype_id
+
+    def test_nested_in_collection(self, django_assert_num_queries):
+        archetype = factories.ArchetypeFactory()
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(3, parent=parent, archetype=archetype)
+
+        # One subquery for children, archetype is joined within it
+        assert str(models.Cat.objects.include('children__archetype').query).count('SELECT') == 2
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children__archetype').get(pk=parent.pk)
+            for child in cat.children.all():
+                assert child.archetype.pk == archetype.pk
+                assert child.archetype.color == archetype.color
+
+    def test_does_not_shadow_host(self, django_assert_num_queries):
+        archetype = factories.ArchetypeFactory()
+        factories.CatFactory.create_batch(2, archetype=archetype)
+        factories.CatFactory.create_batch(2)
+
+        with django_assert_num_queries(1):
+            included = models.Archetype.objects.include('cat_set__archetype').get(pk=archetype.pk)
+            assert len(included.cat_set.all()) == 2
+            for cat in included.cat_set.all():
+                assert cat.archetype.pk == archetype.pk
+
+    def test_collection_nested_in_join(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        child = factories.CatFactory(parent=parent)
+        factories.CatFactory.create_batch(2, parent=parent)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('parent__children__archetype').get(pk=child.pk)
+            assert len(cat.parent.children.all()) == 3
+            for sibling in cat.parent.children.all():
+                assert sibling.archetype.pk == sibling.archetype_id
+
+    def test_reuses_joins(self, django_assert_num_queries):
+        parent = factories.CatFactory(name='Henry')
+        child = factories.CatFactory(parent=parent)
+        factories.CatFactory(parent=factories.CatFactory())
+
+        qs = models.Cat.objects.select_related('parent').include('parent').filter(parent__name='Henry')
+        assert str(qs.query).count('JOIN') == 1
+
+        with django_assert_num_queries(1):
+            assert [cat.parent.pk for cat in qs] == [parent.pk]
+            assert qs[0].pk == child.pk
+
+    def test_annotate(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('archetype', 'parent__archetype').annotate(num_children=Count('children')).get(pk=parent.pk)
+            assert cat.num_children == 2
+            assert cat.archetype.pk == parent.archetype_id
+            assert cat.parent is None
+
+    def test_none_drops_joins(self):
+        assert 'JOIN' not in str(models.Cat.objects.include('archetype', 'parent').include(None).query)
 
 
 @pytest.mark.django_db
@@ -366,3 +491,1801 @@ class TestGeneratedAccessors:
             for post in models.Post.objects.include('authors__comment_set'):
                 for author in post.authors.all():
                     assert len(author.comment_set.all()) == 0
+
+
+@pytest.mark.django_db
+class TestLimitIncludes:
+
+    def test_limit(self, django_assert_num_queries):
+        for _ in range(3):
+            parent = factories.CatFactory()
+            factories.CatFactory.create_batch(10, parent=parent)
+
+        with django_assert_num_queries(1):
+            for cat in models.Cat.objects.include('children', limit_includes=4).filter(parent__isnull=True):
+                assert len(cat.children.all()) == 4
+                for child in cat.children.all():
+                    assert child.parent_id == cat.id
+
+    def test_limit_respects_ordering(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        for name in ('d', 'b', 'e', 'a', 'c'):
+            factories.AliasFactory(describes=cat, name=name)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('aliases', limit_includes={'aliases': 3}).get(pk=cat.pk)
+            assert [alias.name for alias in cat.aliases.all()] == ['a', 'b', 'c']
+
+    def test_unlimited_respects_ordering(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        for name in ('d', 'b', 'e', 'a', 'c'):
+            factories.AliasFactory(describes=cat, name=name)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('aliases').get(pk=cat.pk)
+            assert [alias.name for alias in cat.aliases.all()] == ['a', 'b', 'c', 'd', 'e']
+
+    def test_limit_per_path(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        for child in factories.CatFactory.create_batch(10, parent=parent):
+            factories.AliasFactory.create_batch(5, describes=child)
+        parent.siblings.add(*factories.CatFactory.create_batch(4))
+
+        qs = models.Cat.objects.include('siblings', 'children__aliases', limit_includes={'children': 6, 'children__aliases': 2})
+
+        with django_assert_num_queries(1):
+            cat = qs.get(pk=parent.pk)
+            assert len(cat.siblings.all()) == 4
+            assert len(cat.children.all()) == 6
+            for child in cat.children.all():
+                assert len(child.aliases.all()) == 2
+
+    def test_limit_survives_chaining(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(5, parent=parent)
+
+        qs = models.Cat.objects.include('children', limit_includes=2).include('archetype').filter(pk=parent.pk)
+
+        with django_assert_num_queries(1):
+            assert len(qs.get().children.all()) == 2
+
+    def test_limit_many_to_many(self, django_assert_num_queries):
+        post = factories.PostFactory()
+        post.authors.set(factories.AuthorFactory.create_batch(5))
+
+        with django_assert_num_queries(1):
+            post = models.Post.objects.include('authors', limit_includes={'authors': 3}).get(pk=post.pk)
+            assert len(post.authors.all()) == 3
+
+    def test_limit_not_included(self):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include('children', limit_includes={'siblings': 3})
+        assert e.value.args == ('"siblings" has not been included', )
+
+    def test_limit_single_valued(self):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include('archetype', limit_includes={'archetype': 3})
+        assert e.value.args == ('Cannot limit "archetype", limits only apply to many-valued relationships', )
+
+
+@pytest.mark.django_db
+class TestProjection:
+
+    def test_only(self, django_assert_num_queries):
+        post = factories.PostFactory()
+        author = factories.AuthorFactory()
+        factories.CommentFactory.create_batch(3, post=post, author=author)
+
+        with django_assert_num_queries(1):
+            post = models.Post.objects.include('comment_set', only={'comment_set': ['author']}).get(pk=post.pk)
+            comments = post.comment_set.all()
+            assert len(comments) == 3
+            for comment in comments:
+                assert comment.author_id == author.id
+                # post_id is filled in by the cached reference back to the post
+                assert comment.post_id == post.id
+                assert comment.get_deferred_fields() == {'content'}
+
+        # Deferred fields are loaded on access, just like QuerySet.only
+        with django_assert_num_queries(1):
+            assert comments[0].content
+
+    def test_defer(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=cat)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', defer={'children': ['name']}).get(pk=cat.pk)
+            for child in cat.children.all():
+                assert child.get_deferred_fields() == {'name'}
+                assert child.parent_id == cat.id
+
+    def test_only_nested(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        child = factories.CatFactory(parent=cat)
+        factories.AliasFactory.create_batch(2, describes=child)
+
+        qs = models.Cat.objects.include('children__aliases', only={'children': ['parent_id'], 'children__aliases': ['name']})
+
+        with django_assert_num_queries(1):
+            cat = qs.get(pk=cat.pk)
+            child = cat.children.all()[0]
+            assert child.get_deferred_fields() == {'name', 'archetype_id', 'emergency_contact_id'}
+            assert len(child.aliases.all()) == 2
+            for alias in child.aliases.all():
+                assert alias.get_deferred_fields() == {'content_type_id', 'object_id'}
+
+    def test_projection_shrinks_sql(self):
+        sql = str(models.Post.objects.include('comment_set', only={'comment_set': ['id']}).query)
+        assert '"content"' not in sql
+
+    def test_not_concrete(self):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include('children', only={'children': ['aliases']})
+        assert e.value.args == ('Cannot only/defer "aliases" on "children", it is not a concrete field', )
+
+
+@pytest.mark.django_db
+class TestPlans:
+
+    def test_plans_are_cached(self):
+        field = models.Cat._meta.get_field('children')
+        qs1 = models.Cat.objects.include('children__aliases')
+        qs2 = models.Cat.objects.include('children__aliases').filter(name='Henry')
+
+        assert include_plan.get_plan(field, qs1._includes[field]) is include_plan.get_plan(field, qs2._includes[field])
+
+    def test_options_change_plans(self):
+        field = models.Cat._meta.get_field('children')
+        qs1 = models.Cat.objects.include('children')
+        qs2 = models.Cat.objects.include('children', limit_includes=2)
+
+        assert include_plan.get_plan(field, qs1._includes[field]) is not include_plan.get_plan(field, qs2._includes[field])
+
+    def test_sql_is_reused(self, monkeypatch, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(3, parent=parent)
+
+        assert len(models.Cat.objects.include('children__archetype').get(pk=parent.pk).children.all()) == 3
+
+        def fail(self):
+            raise AssertionError('{!r} was rebuilt'.format(self.plan))
+        monkeypatch.setattr(IncludeExpression, 'get_constructor', fail)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children__archetype').filter(name=parent.name).get(pk=parent.pk)
+            assert len(cat.children.all()) == 3
+            for child in cat.children.all():
+                assert child.archetype is not None
+
+    def test_host_alias_is_substituted(self):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+        qs = models.Cat.objects.include('children')
+
+        # Renders the plan as a subquery of its own first, then reuses the plan at the top level
+        assert len(models.Cat.objects.filter(id__in=Subquery(qs.filter(id=OuterRef('pk')).values('pk'))).include('children').get(pk=parent.pk).children.all()) == 2
+        assert len(qs.get(pk=parent.pk).children.all()) == 2
+
+    def test_bounded(self, settings):
+        settings.INCLUDE_PLAN_CACHE_SIZE = 2
+        include_plan.plans.clear()
+
+        for name in ('children', 'siblings', 'aliases'):
+            field = models.Cat._meta.get_field(name)
+            include_plan.get_plan(field)
+
+        assert len(include_plan.plans._plans) == 2
+
+
+@pytest.mark.django_db
+class TestDecoding:
+
+    FIELDS = ('id', 'cat_id', 'follow_up_id', 'weight', 'date', 'time', 'started', 'duration', 'notes')
+
+    def assert_same(self, included, fetched):
+        for name in self.FIELDS:
+            assert getattr(included, name) == getattr(fetched, name)
+            assert type(getattr(included, name)) is type(getattr(fetched, name))
+
+        if fetched.xray is None:
+            assert included.xray is None
+        else:
+            assert bytes(included.xray) == bytes(fetched.xray)
+
+    def test_types(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        checkup = factories.CheckupFactory(cat=cat, xray=None, notes=None)
+        factories.CheckupFactory(cat=cat, follow_up=checkup)
+
+        with django_assert_num_queries(1):
+            included = models.Cat.objects.include('checkups').get(pk=cat.pk).checkups.all()
+
+        for checkup in included:
+            self.assert_same(checkup, models.Checkup.objects.get(pk=checkup.pk))
+
+    def test_nested_and_single_valued(self, django_assert_num_queries):
+        checkup = factories.CheckupFactory()
+        follow_up = factories.CheckupFactory(cat=checkup.cat, follow_up=checkup)
+
+        with django_assert_num_queries(1):
+            included = models.Checkup.objects.include('follow_up', 'follow_ups').get(pk=follow_up.pk)
+            self.assert_same(included.follow_up, checkup)
+            assert len(included.follow_ups.all()) == 0
+
+        with django_assert_num_queries(1):
+            included = models.Checkup.objects.include('follow_ups__follow_up').get(pk=checkup.pk)
+            self.assert_same(included.follow_ups.all()[0], follow_up)
+            self.assert_same(included.follow_ups.all()[0].follow_up, checkup)
+
+    def test_decimal_precision(self):
+        checkup = factories.CheckupFactory(weight=decimal.Decimal('1234567890.0123456789'))
+
+        included = models.Cat.objects.include('checkups').get(pk=checkup.cat_id).checkups.all()[0]
+        assert included.weight == decimal.Decimal('1234567890.0123456789')
+
+    @pytest.mark.parametrize('decoder', [None, 'json', 'ujson', 'orjson'])
+    def test_json_decoder(self, settings, decoder):
+        pytest.importorskip(decoder or 'json')
+        settings.INCLUDE_JSON_DECODER = decoder
+        cat = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=cat)
+
+        assert len(models.Cat.objects.include('children__parent').get(pk=cat.pk).children.all()) == 2
+
+    def test_custom_json_decoder(self, settings):
+        settings.INCLUDE_JSON_DECODER = 'tests.test_include.counting_loads'
+        cat = factories.CatFactory(parent=factories.CatFactory())
+        factories.CatFactory.create_batch(2, parent=cat)
+        del DECODED[:]
+
+        cat = models.Cat.objects.include('parent', 'children__parent').get(pk=cat.pk)
+
+        # Once per included column, nested includes arrive already decoded
+        assert len(DECODED) == 2
+        assert cat.parent.pk == cat.parent_id
+        assert len(cat.children.all()) == 2
+        assert all(child.parent.pk == cat.pk for child in cat.children.all())
+
+
+@pytest.mark.django_db
+class TestIterator:
+
+    def test_iterator(self, django_assert_num_queries):
+        for _ in range(5):
+            parent = factories.CatFactory()
+            factories.CatFactory.create_batch(3, parent=parent)
+
+        with django_assert_num_queries(1):
+            cats = list(models.Cat.objects.include('children__archetype').filter(parent__isnull=True).iterator(chunk_size=2))
+            assert len(cats) == 5
+            for cat in cats:
+                assert len(cat.children.all()) == 3
+                for child in cat.children.all():
+                    assert child.archetype is not None
+
+    def test_memory_is_bounded(self):
+        author = factories.AuthorFactory()
+        posts = models.Post.objects.bulk_create([models.Post(title='Post {}'.format(i)) for i in range(400)])
+        models.Comment.objects.bulk_create([
+            models.Comment(post=post, author=author, content='meow' * 1000)
+            for post in posts
+            for _ in range(10)
+        ])
+
+        def peak(consume, qs):
+            count, qs = qs.count(), qs.all()
+            tracemalloc.start()
+            try:
+                assert consume(qs) == 10 * count
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        def stream(qs):
+            count = 0
+            for i, post in enumerate(qs.iterator(chunk_size=20)):
+                count += len(post.comment_set.all())
+                # Included objects reference their parents, let the cycles of previous chunks be collected
+                # so that only what is still held onto is measured
+                if i % 20 == 0:
+                    gc.collect()
+            return count
+
+        def materialize(qs):
+            return sum(len(post.comment_set.all()) for post in list(qs))
+
+        small = models.Post.objects.include('comment_set').filter(pk__in=[post.pk for post in posts[:100]])
+        large = models.Post.objects.include('comment_set')
+
+        # Every post carries ~40KB of comments. Streaming should only ever hold a few chunks worth,
+        # no matter how many posts there are, where materializing grows with the number of posts
+        streamed = peak(stream, large)
+        assert streamed < 1.5 * peak(stream, small)
+        assert streamed * 4 < peak(materialize, large)
+
+
+@pytest.mark.django_db
+class TestLazy:
+
+    def test_hydrated_on_access(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        for child in factories.CatFactory.create_batch(3, parent=parent):
+            factories.AliasFactory.create_batch(2, describes=child)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('archetype', 'children__aliases', lazy=True).get(pk=parent.pk)
+
+        assert dict.__len__(cat._prefetched_objects_cache) == 0
+        assert dict.__len__(cat._state.fields_cache) == 0
+
+        with django_assert_num_queries(0):
+            assert cat.archetype.pk == parent.archetype_id
+            assert len(cat.children.all()) == 3
+            for child in cat.children.all():
+                assert child.parent is cat
+                assert dict.__len__(child._prefetched_objects_cache) == 0
+                assert len(child.aliases.all()) == 2
+
+    def test_is_cached(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory(parent=parent, emergency_contact=parent)
+
+        cat = models.Cat.objects.include('emergency_contact_for', 'children', lazy=True).get(pk=parent.pk)
+        assert models.Cat._meta.get_field('emergency_contact_for').is_cached(cat)
+        assert 'children' in cat._prefetched_objects_cache
+
+        # prefetch_related picks up on lazily included objects as well
+        with django_assert_num_queries(0):
+            prefetch_related_objects([cat], 'children')
+            assert cat.emergency_contact_for.emergency_contact_id == cat.id
+
+    def test_invalidated(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+        sibling = factories.CatFactory()
+
+        cat = models.Cat.objects.include('siblings', lazy=True).get(pk=parent.pk)
+        cat.siblings.add(sibling)
+
+        with django_assert_num_queries(1):
+            assert list(cat.siblings.all()) == [sibling]
+
+    def test_pickle(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+
+        cat = pickle.loads(pickle.dumps(models.Cat.objects.include('archetype', 'children', lazy=True).get(pk=parent.pk)))
+
+        with django_assert_num_queries(0):
+            assert cat.archetype.pk == parent.archetype_id
+            assert len(cat.children.all()) == 2
+
+
+@pytest.mark.django_db
+class TestSignals:
+
+    def test_collect(self):
+        parent = factories.CatFactory()
+        for child in factories.CatFactory.create_batch(3, parent=parent):
+            factories.AliasFactory.create_batch(2, describes=child)
+
+        with signals.collect() as stats:
+            list(models.Cat.objects.include('archetype', 'children__aliases'))
+
+        assert set(stats) == {(models.Cat, 'archetype'), (models.Cat, 'children'), (models.Cat, 'children__aliases')}
+        assert stats[(models.Cat, 'archetype')]['rows'] == 4
+        assert stats[(models.Cat, 'children')]['rows'] == 3
+        assert stats[(models.Cat, 'children__aliases')]['rows'] == 6
+
+        for path in ('archetype', 'children'):
+            assert stats[(models.Cat, path)]['bytes'] > 0
+            assert stats[(models.Cat, path)]['compile_time'] > 0
+            assert stats[(models.Cat, path)]['decode_time'] > 0
+            assert stats[(models.Cat, path)]['hydrate_time'] > 0
+
+        # Nested includes arrive decoded and are compiled with their parent
+        assert stats[(models.Cat, 'children__aliases')]['bytes'] == 0
+        assert stats[(models.Cat, 'children__aliases')]['compile_time'] == 0
+        assert stats[(models.Cat, 'children__aliases')]['hydrate_time'] > 0
+
+    def test_compiled(self):
+        compiled = []
+
+        def receiver(sender, path, plan, duration, cached, **kwargs):
+            compiled.append((sender, path, cached))
+
+        include_plan.plans.clear()
+        signals.include_compiled.connect(receiver, sender=models.Cat)
+        try:
+            list(models.Cat.objects.include('children'))
+            list(models.Cat.objects.include('children'))
+            list(models.Archetype.objects.include('cat_set'))
+        finally:
+            signals.include_compiled.disconnect(receiver, sender=models.Cat)
+
+        assert compiled == [(models.Cat, 'children', False), (models.Cat, 'children', True)]
+
+    def test_chunks(self):
+        for parent in factories.CatFactory.create_batch(5):
+            factories.CatFactory.create_batch(2, parent=parent)
+        hydrated = []
+
+        def receiver(sender, path, rows, **kwargs):
+            hydrated.append((path, rows))
+
+        signals.include_hydrated.connect(receiver)
+        try:
+            list(models.Cat.objects.filter(parent__isnull=True).include('children').iterator(chunk_size=2))
+        finally:
+            signals.include_hydrated.disconnect(receiver)
+
+        assert hydrated == [('children', 4), ('children', 4), ('children', 2)]
+
+    def test_lazy(self):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(3, parent=parent)
+
+        with signals.collect() as stats:
+            cat = models.Cat.objects.include('children__aliases', lazy=True).get(pk=parent.pk)
+            assert stats[(models.Cat, 'children')]['rows'] == 0
+            assert stats[(models.Cat, 'children')]['bytes'] > 0
+
+            for child in cat.children.all():
+                child.aliases.all()
+
+        assert stats[(models.Cat, 'children')]['rows'] == 3
+        assert stats[(models.Cat, 'children__aliases')]['rows'] == 0
+        assert stats[(models.Cat, 'children__aliases')]['hydrate_time'] > 0
+
+    def test_no_listeners(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError('Stats were gathered')
+
+        monkeypatch.setattr(signals, 'IncludeReport', fail)
+        monkeypatch.setattr(signals.include_compiled, 'send', fail)
+        factories.CatFactory.create_batch(2, parent=factories.CatFactory())
+
+        assert len(list(models.Cat.objects.include('children__aliases'))) == 3
+
+
+@pytest.mark.django_db
+class TestStrategy:
+
+    @pytest.fixture(autouse=True)
+    def estimates(self):
+        strategy.estimates.clear()
+        yield
+        strategy.estimates.clear()
+
+    def test_invalid(self):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include('children', strategy='fastest')
+        assert e.value.args == ('Unknown strategy "fastest", expected one of "json", "auto"', )
+
+    def test_small_fanout_aggregates(self, settings, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+
+        list(models.Cat.objects.include('children', strategy='auto'))
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', strategy='auto').get(pk=parent.pk)
+            assert len(cat.children.all()) == 2
+
+    @pytest.mark.parametrize('path', ['archetype', 'children', 'siblings', 'related_to', 'aliases', 'organizations', 'emergency_contact_for'])
+    def test_large_fanout_prefetches(self, settings, django_assert_num_queries, path):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        organization = models.Organization.objects.create(title='Cat Club')
+        parent = factories.CatFactory()
+        for cat in factories.CatFactory.create_batch(3, parent=parent, emergency_contact=None):
+            parent.siblings.add(cat)
+            cat.siblings.add(parent)
+            models.Membership.objects.create(member=parent, organization=organization)
+            factories.AliasFactory(describes=parent)
+        factories.CatFactory(emergency_contact=parent)
+
+        # Warm up the estimates
+        list(models.Cat.objects.include(path, strategy='auto'))
+        expected = models.Cat.objects.include(path).get(pk=parent.pk)
+
+        with django_assert_num_queries(2):
+            cat = models.Cat.objects.include(path, strategy='auto').get(pk=parent.pk)
+
+        with django_assert_num_queries(0):
+            related = getattr(cat, path)
+            expected = getattr(expected, path)
+            if hasattr(related, 'all'):
+                assert [obj.pk for obj in related.all()] == [obj.pk for obj in expected.all()]
+            else:
+                assert related.pk == expected.pk
+
+    def test_nested(self, settings, django_assert_num_queries):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        parent = factories.CatFactory()
+        for child in factories.CatFactory.create_batch(3, parent=parent):
+            factories.AliasFactory.create_batch(2, describes=child)
+
+        list(models.Cat.objects.include('children__aliases', strategy='auto'))
+
+        with django_assert_num_queries(3):
+            cat = models.Cat.objects.include('children__aliases', strategy='auto').get(pk=parent.pk)
+
+        with django_assert_num_queries(0):
+            assert len(cat.children.all()) == 3
+            for child in cat.children.all():
+                assert child.parent is cat
+                assert len(child.aliases.all()) == 2
+
+    def test_options_aggregate(self, settings, django_assert_num_queries):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(3, parent=parent)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', strategy='auto', limit_includes=2).get(pk=parent.pk)
+            assert len(cat.children.all()) == 2
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', strategy='auto', only={'children': ['name']}).get(pk=parent.pk)
+            assert len(cat.children.all()) == 3
+
+    def test_iterator(self, settings, django_assert_num_queries):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        for parent in factories.CatFactory.create_batch(5):
+            factories.CatFactory.create_batch(2, parent=parent)
+
+        list(models.Cat.objects.include('children', strategy='auto'))
+
+        # Prefetches a chunk at a time
+        with django_assert_num_queries(4):
+            cats = list(models.Cat.objects.filter(parent__isnull=True).include('children', strategy='auto').iterator(chunk_size=2))
+
+        with django_assert_num_queries(0):
+            assert [len(cat.children.all()) for cat in cats] == [2] * 5
+
+    def test_many_parents(self, settings, django_assert_num_queries):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        archetype = factories.ArchetypeFactory()
+        parents = models.Cat.objects.bulk_create(factories.CatFactory.build_batch(350, archetype=archetype))
+        models.Cat.objects.bulk_create([factories.CatFactory.build(parent=parent, archetype=archetype) for parent in parents])
+
+        list(models.Cat.objects.include('children', strategy='auto'))
+
+        # Like prefetch_related, a single prefetch rather than one per chunk
+        with django_assert_num_queries(2):
+            cats = list(models.Cat.objects.filter(parent__isnull=True).include('children', strategy='auto'))
+
+        with django_assert_num_queries(0):
+            assert [len(cat.children.all()) for cat in cats] == [1] * 350
+
+    def test_sampled_estimate(self):
+        for parent in factories.CatFactory.create_batch(5):
+            factories.CatFactory.create_batch(4, parent=parent)
+
+        assert strategy.estimate(models.Cat._meta.get_field('children'), 'default').fanout == 4
+        assert strategy.estimate(models.Cat._meta.get_field('parent'), 'default').fanout == 1
+
+    def test_planner_estimate(self):
+        for parent in factories.CatFactory.create_batch(5):
+            factories.CatFactory.create_batch(4, parent=parent)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE tests_cat')
+
+        fanout, width = strategy.estimate(models.Cat._meta.get_field('children'), 'default')
+        # The parents, without a parent of their own, are no one's children
+        assert fanout == pytest.approx(4)
+        assert width > 0
+
+
+@pytest.mark.django_db
+class TestLateral:
+
+    def test_compiled_as_lateral_joins(self):
+        sql = str(models.Cat.objects.include('archetype', 'children__aliases', 'siblings', lateral=True).query)
+
+        assert sql.count('LEFT OUTER JOIN LATERAL') == 2
+        assert 'INNER JOIN "tests_archetype"' in sql
+
+    @pytest.mark.parametrize('paths', [
+        ('children', ),
+        ('children__aliases', 'archetype'),
+        ('siblings', 'related_to'),
+        ('aliases', 'organizations'),
+        ('emergency_contact_for', 'parent__children'),
+    ])
+    def test_identical(self, django_assert_num_queries, paths):
+        organization = models.Organization.objects.create(title='Cat Club')
+        for parent in factories.CatFactory.create_batch(3):
+            models.Membership.objects.create(member=parent, organization=organization)
+            factories.AliasFactory.create_batch(2, describes=parent)
+            for child in factories.CatFactory.create_batch(3, parent=parent):
+                parent.siblings.add(child)
+                factories.AliasFactory.create_batch(2, describes=child)
+            factories.CatFactory(emergency_contact=parent)
+
+        qs = models.Cat.objects.order_by('pk')
+        expected = list(qs.include(*paths))
+
+        with django_assert_num_queries(1):
+            lateral = list(qs.include(*paths, lateral=True))
+
+        assert [cat.pk for cat in lateral] == [cat.pk for cat in expected]
+        with django_assert_num_queries(0):
+            for a, b in zip(lateral, expected):
+                for path in paths:
+                    assert related_pks(a, path) == related_pks(b, path)
+
+    def test_limit(self, django_assert_num_queries):
+        cat = factories.CatFactory()
+        for name in ('d', 'b', 'e', 'a', 'c'):
+            factories.AliasFactory(describes=cat, name=name)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('aliases', limit_includes=3, lateral=True).get(pk=cat.pk)
+            assert [alias.name for alias in cat.aliases.all()] == ['a', 'b', 'c']
+
+    def test_annotate(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        parent.siblings.add(*factories.CatFactory.create_batch(2))
+        factories.CatFactory.create_batch(3, parent=parent)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', lateral=True).annotate(num_siblings=Count('siblings')).get(pk=parent.pk)
+            assert cat.num_siblings == 2
+            assert len(cat.children.all()) == 3
+
+    def test_not_selected(self):
+        factories.CatFactory.create_batch(2, parent=factories.CatFactory())
+        qs = models.Cat.objects.include('children', lateral=True)
+
+        assert 'LATERAL' not in str(models.Cat.objects.filter(pk__in=qs.values('pk')).query)
+        assert qs.count() == 3
+        assert len(qs.values_list('pk', flat=True)) == 3
+
+    def test_plan(self):
+        archetype = factories.ArchetypeFactory()
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO tests_cat (name, archetype_id) SELECT 'Cat ' || i, %s FROM generate_series(1, 100000) i", [archetype.pk])
+            cursor.execute("INSERT INTO tests_cat (name, archetype_id, parent_id) SELECT 'Kitten ' || k, %s, id FROM tests_cat, generate_series(1, 3) k WHERE id %% 100 = 0", [archetype.pk])
+            cursor.execute('ANALYZE tests_cat')
+
+        qs = models.Cat.objects.filter(parent__isnull=True)
+
+        # The aggregate is run by a SubPlan in the select list, or as the inner side of a join. Either way once per parent
+        assert 'SubPlan' in qs.include('children').explain()
+        assert 'SubPlan' not in qs.include('children', lateral=True).explain()
+        assert 'Nested Loop Left Join' in qs.include('children', lateral=True).explain()
+
+        qs = qs.filter(pk__in=list(qs.order_by('pk').values_list('pk', flat=True)[:5000])).order_by('pk')
+
+        # Ordered, so both pick the same children to limit to
+        children = Include('children', queryset=models.Cat.objects.order_by('-name'))
+
+        for limit, total in ((None, 150), (2, 100)):
+            expected = [
+                (cat.pk, [(child.pk, child.name, child.parent_id) for child in cat.children.all()])
+                for cat in qs.include(children, limit_includes=limit)
+            ]
+            lateral = [
+                (cat.pk, [(child.pk, child.name, child.parent_id) for child in cat.children.all()])
+                for cat in qs.include(children, limit_includes=limit, lateral=True)
+            ]
+            assert lateral == expected
+            assert sum(len(children) for _, children in lateral) == total
+
+
+@pytest.mark.django_db
+class TestIdentityMap:
+
+    def test_shared(self, django_assert_num_queries):
+        archetype = factories.ArchetypeFactory()
+        factories.AliasFactory.create_batch(2, describes=archetype)
+        factories.CatFactory.create_batch(5, archetype=archetype)
+
+        with django_assert_num_queries(1):
+            cats = list(models.Cat.objects.include('archetype__aliases', identity_map=True))
+            assert len({id(cat.archetype) for cat in cats}) == 1
+            assert len(cats[0].archetype.aliases.all()) == 2
+
+    def test_many_to_many(self):
+        authors = factories.AuthorFactory.create_batch(2)
+        for post in factories.PostFactory.create_batch(3):
+            post.authors.set(authors)
+
+        posts = list(models.Post.objects.include('authors', identity_map=True))
+        assert len({id(author) for post in posts for author in post.authors.all()}) == 2
+
+    def test_independent(self):
+        archetype = factories.ArchetypeFactory()
+        factories.CatFactory.create_batch(3, archetype=archetype)
+
+        # Parents get copies of their own unless asked otherwise
+        for cats in (list(models.Cat.objects.include('archetype')), list(models.Cat.objects.include('archetype', identity_map=False))):
+            assert len({id(cat.archetype) for cat in cats}) == 3
+            assert {cat.archetype.pk for cat in cats} == {archetype.pk}
+
+        cats[0].archetype.color = 'Mauve'
+        assert cats[1].archetype.color != 'Mauve'
+
+    def test_projections_are_not_shared(self):
+        archetype = factories.ArchetypeFactory()
+        parent = factories.CatFactory(archetype=archetype)
+        factories.CatFactory(parent=parent, archetype=archetype)
+
+        cat = models.Cat.objects.include('archetype', 'children__archetype', only={'archetype': ['color']}, identity_map=True).get(pk=parent.pk)
+        child = cat.children.all()[0]
+
+        assert cat.archetype is not child.archetype
+        assert cat.archetype.get_deferred_fields() == {'num_toes'}
+        assert child.archetype.get_deferred_fields() == set()
+
+    def test_lazy(self, django_assert_num_queries):
+        archetype = factories.ArchetypeFactory()
+        for parent in factories.CatFactory.create_batch(2, archetype=archetype):
+            factories.CatFactory.create_batch(2, parent=parent, archetype=archetype)
+
+        with django_assert_num_queries(1):
+            cats = list(models.Cat.objects.filter(parent__isnull=True).include('archetype', 'children__archetype', lazy=True, identity_map=True))
+            assert len({id(cat.archetype) for cat in cats} | {id(child.archetype) for cat in cats for child in cat.children.all()}) == 1
+
+    def test_scoped_to_chunks(self):
+        archetype = factories.ArchetypeFactory()
+        factories.CatFactory.create_batch(4, archetype=archetype)
+
+        cats = list(models.Cat.objects.include('archetype', identity_map=True).iterator(chunk_size=2))
+        assert len({id(cat.archetype) for cat in cats}) == 2
+
+
+@pytest.mark.django_db
+class TestNormalize:
+
+    def test_invalid(self):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include('children', normalize=True)
+        assert e.value.args == ('Cannot normalize "children", only many to many relations and forward foreign keys share related rows', )
+
+    def test_keys_only(self):
+        sql = str(models.Cat.objects.include('organizations', 'archetype', normalize=True).query)
+
+        assert '"tests_organization"."title"' not in sql
+        assert 'tests_archetype' not in sql
+
+    @pytest.mark.parametrize('path', ['archetype', 'organizations', 'siblings', 'related_to', 'organizations__members'])
+    def test_identical(self, django_assert_num_queries, path):
+        organizations = [models.Organization.objects.create(title=str(i)) for i in range(3)]
+        cats = factories.CatFactory.create_batch(4)
+        for cat in cats:
+            cat.siblings.add(*[sibling for sibling in cats if sibling != cat][:2])
+            for organization in organizations[:2]:
+                models.Membership.objects.create(member=cat, organization=organization)
+
+        qs = models.Cat.objects.order_by('pk')
+        expected = list(qs.include(path))
+
+        with django_assert_num_queries(2):
+            normalized = list(qs.include(path, normalize=True))
+
+        with django_assert_num_queries(0):
+            for a, b in zip(normalized, expected):
+                assert related_pks(a, path) == related_pks(b, path)
+
+    def test_shared(self, django_assert_num_queries):
+        organization = models.Organization.objects.create(title='Cat Club')
+        for cat in factories.CatFactory.create_batch(3):
+            models.Membership.objects.create(member=cat, organization=organization)
+
+        cats = list(models.Cat.objects.include('organizations', normalize=True))
+        assert len({id(cat.organizations.all()[0]) for cat in cats}) == 1
+
+    def test_options(self, django_assert_num_queries):
+        cat = factories.CatFactory(archetype=factories.ArchetypeFactory(color='tabby'))
+        for i in range(3):
+            models.Membership.objects.create(member=cat, organization=models.Organization.objects.create(title=str(i)))
+
+        with django_assert_num_queries(3):
+            cat = models.Cat.objects.include(
+                'organizations', 'archetype',
+                normalize=True,
+                limit_includes={'organizations': 2},
+                only={'archetype': ['color']},
+            ).get(pk=cat.pk)
+
+        with django_assert_num_queries(0):
+            assert len(cat.organizations.all()) == 2
+            assert cat.archetype.color == 'tabby'
+        assert cat.archetype.get_deferred_fields() == {'num_toes'}
+
+    def test_many_parents(self, django_assert_num_queries):
+        archetypes = factories.ArchetypeFactory.create_batch(3)
+        models.Cat.objects.bulk_create([factories.CatFactory.build(archetype=archetypes[i % 3]) for i in range(350)])
+
+        # Rows shared by parents more than 100, a chunk, apart are loaded once
+        with django_assert_num_queries(2):
+            cats = list(models.Cat.objects.include('archetype', normalize=True))
+
+        assert len({id(cat.archetype) for cat in cats}) == 3
+
+    def test_null(self):
+        factories.CatFactory(emergency_contact=None)
+
+        cats = list(models.Cat.objects.include('emergency_contact', normalize=True))
+        assert cats[0].emergency_contact is None
+
+
+@pytest.mark.django_db
+class TestValues:
+
+    def test_values(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        children = factories.CatFactory.create_batch(2, parent=parent)
+        factories.AliasFactory(describes=children[0], name='Tom')
+
+        with django_assert_num_queries(1):
+            values = list(models.Cat.objects.filter(pk=parent.pk).include('archetype', 'children__aliases').include_values('name'))
+
+        assert values == [{
+            'name': parent.name,
+            'archetype': {'id': parent.archetype.pk, 'color': parent.archetype.color, 'num_toes': parent.archetype.num_toes},
+            'children': [{
+                'id': child.pk,
+                'archetype_id': child.archetype_id,
+                'name': child.name,
+                'parent_id': parent.pk,
+                'emergency_contact_id': None,
+                'aliases': [{'id': alias.pk, 'content_type_id': alias.content_type_id, 'name': alias.name, 'object_id': alias.object_id} for alias in child.aliases.all()],
+            } for child in children],
+        }]
+
+    def test_all_fields(self):
+        cat = factories.CatFactory(emergency_contact=None)
+
+        values = models.Cat.objects.include('emergency_contact', 'children').include_values().get(pk=cat.pk)
+        assert values == {
+            'id': cat.pk,
+            'archetype_id': cat.archetype_id,
+            'name': cat.name,
+            'parent_id': None,
+            'emergency_contact_id': None,
+            'emergency_contact': None,
+            'children': [],
+        }
+
+    def test_decoded(self):
+        checkup = factories.CheckupFactory(weight=decimal.Decimal('1234567890.0123456789'))
+
+        values = models.Cat.objects.include('checkups', only={'checkups': ['weight', 'started', 'duration']}).include_values('pk').get(pk=checkup.cat_id)
+        assert values['checkups'] == [{'id': checkup.pk, 'weight': checkup.weight, 'started': checkup.started, 'duration': checkup.duration}]
+
+    def test_values_list(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        child = factories.CatFactory(parent=parent)
+        alias = factories.AliasFactory(describes=child)
+
+        qs = models.Cat.objects.filter(pk=parent.pk).include('children__aliases', only={'children': ['name'], 'children__aliases': ['name']})
+        with django_assert_num_queries(2):
+            assert list(qs.include_values_list('name', 'pk')) == [(parent.name, parent.pk, [(child.pk, child.name, [(alias.pk, alias.name)])])]
+            assert list(qs.include_values_list()) == [(parent.pk, parent.archetype_id, parent.name, None, None, [(child.pk, child.name, [(alias.pk, alias.name)])])]
+
+    def test_normalized(self):
+        with pytest.raises(ValueError):
+            models.Cat.objects.include('organizations', normalize=True).include_values()
+
+
+@pytest.mark.django_db
+class TestJSON:
+
+    def test_rows(self, django_assert_num_queries):
+        parent = factories.CatFactory(emergency_contact=None)
+        child = factories.CatFactory(parent=parent, emergency_contact=None)
+        alias = factories.AliasFactory(describes=child)
+
+        qs = models.Cat.objects.filter(pk=parent.pk).include('archetype', 'children__aliases', only={'children__aliases': ['name']})
+        with django_assert_num_queries(1):
+            rows = list(qs.include_json())
+
+        assert isinstance(rows[0], str)
+        assert [json.loads(row) for row in rows] == [{
+            'id': parent.pk,
+            'archetype_id': parent.archetype_id,
+            'name': parent.name,
+            'parent_id': None,
+            'emergency_contact_id': None,
+            'archetype': {'id': parent.archetype.pk, 'color': parent.archetype.color, 'num_toes': parent.archetype.num_toes},
+            'children': [{
+                'id': child.pk,
+                'archetype_id': child.archetype_id,
+                'name': child.name,
+                'parent_id': parent.pk,
+                'emergency_contact_id': None,
+                'aliases': [{'id': alias.pk, 'name': alias.name}],
+            }],
+        }]
+
+    def test_fields(self):
+        cat = factories.CatFactory()
+        factories.CatFactory(parent=cat)
+
+        row = models.Cat.objects.include('siblings', lateral=True).include_json('name', 'archetype__color').get(pk=cat.pk)
+        assert json.loads(row) == {'name': cat.name, 'archetype__color': cat.archetype.color, 'siblings': []}
+
+    def test_aggregate(self, django_assert_num_queries):
+        cats = factories.CatFactory.create_batch(3)
+        for cat in cats:
+            factories.CatFactory.create_batch(2, parent=cat)
+
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('-pk').include('children')
+        with django_assert_num_queries(1):
+            document = qs.include_json('id', aggregate=True)
+
+        assert isinstance(document, str)
+        assert [row['id'] for row in json.loads(document)] == [cat.pk for cat in reversed(cats)]
+        assert [len(row['children']) for row in json.loads(document)] == [2, 2, 2]
+
+    def test_aggregate_empty(self):
+        assert models.Cat.objects.include('children').include_json(aggregate=True) == '[]'
+        assert models.Cat.objects.none().include('children').include_json(aggregate=True) == '[]'
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAsync:
+
+    def test_aiterator(self):
+        for parent in factories.CatFactory.create_batch(5):
+            factories.CatFactory.create_batch(2, parent=parent)
+
+        async def consume():
+            return [(cat, len(cat.children.all())) async for cat in models.Cat.objects.filter(parent__isnull=True).include('children').aiterator(chunk_size=2)]
+
+        cats = run_async(consume())
+        assert len(cats) == 5
+        assert all(count == 2 for cat, count in cats)
+
+    def test_interleaved(self):
+        factories.CatFactory.create_batch(4)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        async def consume():
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return [cat.pk async for cat in models.Cat.objects.include('archetype').order_by('pk')]
+            finally:
+                ticker.cancel()
+
+        assert run_async(consume()) == list(models.Cat.objects.order_by('pk').values_list('pk', flat=True))
+        # The event loop kept running while rows were loaded
+        assert ticks
+
+    def test_break(self):
+        factories.CatFactory.create_batch(5)
+
+        async def consume():
+            async for cat in models.Cat.objects.include('archetype').aiterator(chunk_size=1):
+                return cat
+
+        assert run_async(consume()).archetype is not None
+
+    def test_aget(self):
+        cat = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=cat)
+
+        fetched = run_async(models.Cat.objects.include('children').aget(pk=cat.pk))
+        assert len(fetched.children.all()) == 2
+
+        with pytest.raises(models.Cat.DoesNotExist):
+            run_async(models.Cat.objects.include('children').aget(pk=-1))
+
+    def test_afirst(self):
+        assert run_async(models.Cat.objects.include('children').afirst()) is None
+
+        cat = factories.CatFactory()
+        assert run_async(models.Cat.objects.include('children').afirst()) == cat
+
+    def test_connection_reused(self, monkeypatch):
+        cat = factories.CatFactory()
+        created = []
+
+        def receiver(sender, connection, **kwargs):
+            created.append(connection)
+
+        monkeypatch.setitem(connections['default'].settings_dict, 'CONN_MAX_AGE', 60)
+        connection_created.connect(receiver)
+        try:
+            for _ in range(3):
+                assert run_async(models.Cat.objects.include('children').aget(pk=cat.pk)) == cat
+        finally:
+            connection_created.disconnect(receiver)
+            AsyncWorker.get('default').submit(lambda: connections['default'].close()).result()
+
+        assert len(created) == 1
+
+    def test_connection_closed(self):
+        cat = factories.CatFactory()
+
+        assert run_async(models.Cat.objects.include('children').aget(pk=cat.pk)) == cat
+        # CONN_MAX_AGE defaults to 0, closed at the end of every call
+        assert AsyncWorker.get('default').submit(lambda: connections['default'].connection).result() is None
+
+    def test_concurrent(self):
+        cats = factories.CatFactory.create_batch(5)
+
+        async def consume():
+            iterator = models.Cat.objects.include('archetype').order_by('pk').aiterator(chunk_size=1).__aiter__()
+            first = await iterator.__anext__()
+            # Ends a call of its own, leaving the connection, and server side cursor, of the iterator open
+            assert await models.Cat.objects.include('archetype').aget(pk=cats[0].pk) == first
+            return [first] + [cat async for cat in iterator]
+
+        assert run_async(consume()) == cats
+
+    def test_collect(self):
+        for parent in factories.CatFactory.create_batch(3):
+            factories.CatFactory.create_batch(2, parent=parent)
+
+        async def consume():
+            cats = [cat async for cat in models.Cat.objects.filter(parent__isnull=True).include('children').aiterator(chunk_size=2)]
+            await models.Cat.objects.include('children').aget(pk=cats[0].pk)
+
+        with signals.collect() as stats:
+            run_async(consume())
+
+        assert stats[(models.Cat, 'children')]['rows'] == 8
+        assert stats[(models.Cat, 'children')]['bytes'] > 0
+
+
+@pytest.mark.django_db
+class TestIncludeObject:
+
+    @pytest.fixture
+    def cat(self):
+        cat = factories.CatFactory()
+        for i in range(4):
+            organization = models.Organization.objects.create(title=str(i), disliked=i % 2 == 0)
+            models.Membership.objects.create(member=cat, organization=organization, active=i < 3)
+        for name in ('Alfie', 'Bella', 'Ace'):
+            factories.AliasFactory.create_batch(2, describes=factories.CatFactory(parent=cat, name=name))
+        return cat
+
+    def test_filtered(self, cat, django_assert_num_queries):
+        expected = list(models.Membership.objects.filter(active=True).order_by('-id').values_list('pk', flat=True))
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(
+                Include('memberships', queryset=models.Membership.objects.filter(active=True).order_by('-id'))
+            ).get(pk=cat.pk)
+            assert [m.pk for m in cat.memberships.all()] == expected
+
+    def test_to_attr(self, cat, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(
+                'organizations',
+                Include('organizations', queryset=models.Organization.objects.filter(disliked=False), to_attr='liked'),
+                Include('organizations', queryset=models.Organization.objects.filter(disliked=True), to_attr='disliked'),
+                Include('organizations', queryset=models.Organization.objects.filter(members__active=False), to_attr='inactive'),
+            ).get(pk=cat.pk)
+
+            assert len(cat.organizations.all()) == 4
+            assert isinstance(cat.liked, list)
+            assert {o.title for o in cat.liked} == {'1', '3'}
+            assert {o.title for o in cat.disliked} == {'0', '2'}
+            assert [o.title for o in cat.inactive] == ['3']
+
+    def test_nested(self, cat, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(
+                Include('children', queryset=models.Cat.objects.filter(name__startswith='A').order_by('name'), to_attr='a_children'),
+                'a_children__aliases',
+                limit_includes={'a_children__aliases': 1},
+            ).get(pk=cat.pk)
+
+            assert [child.name for child in cat.a_children] == ['Ace', 'Alfie']
+            assert [len(child.aliases.all()) for child in cat.a_children] == [1, 1]
+            assert all(child.parent is cat for child in cat.a_children)
+
+    def test_across_many_valued_relations(self, cat, django_assert_num_queries):
+        for child in cat.children.all():
+            factories.AliasFactory.create_batch(2, describes=child, name='Tom')
+
+        # What .distinct() would otherwise be needed for
+        toms = models.Cat.objects.filter(aliases__name='Tom')
+        cat = models.Cat.objects.include(Include('children', queryset=models.Cat.objects.filter(pk__in=toms.values('pk')))).get(pk=cat.pk)
+
+        assert sorted(child.pk for child in cat.children.all()) == sorted(set(toms.values_list('pk', flat=True)))
+
+    @pytest.mark.parametrize('lateral', [False, True])
+    def test_none(self, cat, django_assert_num_queries, lateral):
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(
+                Include('children', queryset=models.Cat.objects.none()),
+                Include('siblings', queryset=models.Cat.objects.none(), to_attr='no_siblings'),
+                Include('organizations', queryset=models.Organization.objects.none(), to_attr='no_organizations'),
+                lateral=lateral,
+            ).include_count(
+                Include('children', queryset=models.Cat.objects.none(), to_attr='no_children'),
+            ).include_exists(
+                Include('aliases', queryset=models.Alias.objects.none(), to_attr='no_aliases'),
+            ).get(pk=cat.pk)
+
+            assert list(cat.children.all()) == []
+            assert cat.no_siblings == [] and cat.no_organizations == []
+            assert cat.no_children == 0
+            assert cat.no_aliases is False
+
+        document = models.Cat.objects.include(Include('children', queryset=models.Cat.objects.none())).include_json('id').get(pk=cat.pk)
+        assert json.loads(document)['children'] == []
+
+    def test_lazy(self, cat, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(Include('children', to_attr='kittens'), 'kittens__aliases', lazy=True).get(pk=cat.pk)
+            assert len(cat.kittens) == 3
+            assert all(len(child.aliases.all()) == 2 for child in cat.kittens)
+
+    def test_values(self, cat):
+        values = models.Cat.objects.include(Include('children', queryset=models.Cat.objects.filter(name='Bella'), to_attr='bellas')).include_values('pk').get(pk=cat.pk)
+        assert [child['name'] for child in values['bellas']] == ['Bella']
+
+    def test_lateral(self, cat, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include(
+                Include('children', queryset=models.Cat.objects.filter(name='Bella'), to_attr='bellas'),
+                'children',
+                lateral=True,
+            ).get(pk=cat.pk)
+            assert [child.name for child in cat.bellas] == ['Bella']
+            assert len(cat.children.all()) == 3
+
+    def test_plans_are_cached(self):
+        include = Include('children', queryset=models.Cat.objects.filter(name='Bella'))
+        field = models.Cat._meta.get_field('children')
+        qs1, qs2 = models.Cat.objects.include(include), models.Cat.objects.include(include)
+
+        assert include_plan.get_plan(field, qs1._includes[field]) is include_plan.get_plan(field, qs2._includes[field])
+
+    def test_equal_querysets_share_plans(self):
+        field = models.Cat._meta.get_field('children')
+        plans = {
+            include_plan.get_plan(field, models.Cat.objects.include(Include('children', queryset=models.Cat.objects.filter(name='Bella').order_by('-pk')))._includes[field])
+            for _ in range(5)
+        }
+        assert len(plans) == 1
+
+        other = models.Cat.objects.include(Include('children', queryset=models.Cat.objects.filter(name='Tom').order_by('-pk')))
+        assert include_plan.get_plan(field, other._includes[field]) not in plans
+
+    @pytest.mark.parametrize('lookup, message', [
+        (Include('archetype', queryset=models.Archetype.objects.all()), 'Cannot filter "archetype", only many-valued includes take a queryset'),
+        (Include('children', queryset=models.Archetype.objects.all()), 'Cannot filter "children" by a queryset of Archetype, expected Cat'),
+        (Include('children', queryset=models.Cat.objects.all()[:3]), 'Cannot filter "children" by a sliced queryset, use limit_includes instead'),
+        (Include('children', queryset=models.Cat.objects.filter(aliases__name__startswith='T').distinct()), 'Cannot filter "children" by a distinct queryset, filter by a subquery instead, ie pk__in=queryset.values("pk")'),
+        (Include('children', queryset=models.Cat.objects.annotate(n=Count('aliases'))), 'Cannot filter "children" by an annotated queryset, included objects only load their fields. Filter by a subquery instead'),
+        (Include('children', queryset=models.Cat.objects.only('name')), 'Cannot filter "children" by a queryset with only or defer, use the only and defer options of include instead'),
+        (Include('children', queryset=models.Cat.objects.defer('name')), 'Cannot filter "children" by a queryset with only or defer, use the only and defer options of include instead'),
+    ])
+    def test_invalid(self, lookup, message):
+        with pytest.raises(ValueError) as e:
+            models.Cat.objects.include(lookup)
+        assert e.value.args == (message, )
+
+    @pytest.mark.parametrize('to_attr', ['children', 'parent', 'parent_id', 'pk', 'siblings', 'save', 'objects'])
+    def test_to_attr_conflicts(self, to_attr):
+        message = 'Cannot include "children" to "{}", it conflicts with a field or attribute of Cat'.format(to_attr)
+        for include in (models.Cat.objects.include, models.Cat.objects.include_count):
+            with pytest.raises(ValueError) as e:
+                include(Include('children', queryset=models.Cat.objects.filter(name='Bella'), to_attr=to_attr))
+            assert e.value.args == (message, )
+
+
+@pytest.mark.django_db
+class TestInMemory:
+
+    @pytest.fixture
+    def parent(self):
+        a1, a2 = factories.ArchetypeFactory(), factories.ArchetypeFactory()
+        parent = factories.CatFactory()
+        for i in range(6):
+            factories.CatFactory(archetype=a1 if i % 2 == 0 else a2, parent=parent, name='Cat {}'.format(i), emergency_contact=parent if i == 0 else None)
+        return models.Cat.objects.include('children', in_memory=True).get(pk=parent.pk)
+
+    def expected(self, parent, method, *args, **kwargs):
+        return [cat.pk for cat in getattr(models.Cat.objects.filter(parent=parent), method)(*args, **kwargs)]
+
+    @pytest.mark.parametrize('method, kwargs', [
+        ('filter', {'archetype': 'a1'}),
+        ('filter', {'archetype_id': 'a1'}),
+        ('filter', {'archetype__in': ['a1']}),
+        ('filter', {'name': 'Cat 3'}),
+        ('filter', {'name__in': ('Cat 1', 'Cat 2')}),
+        ('filter', {'emergency_contact__isnull': False}),
+        ('filter', {'emergency_contact': None}),
+        ('filter', {'pk__gt': 'pk'}),
+        ('filter', {'id__lte': 'pk'}),
+        ('filter', {'pk__range': ('pk', 'pk')}),
+        ('filter', {'archetype': 'a1', 'pk__gte': 'pk'}),
+        ('exclude', {'archetype': 'a1'}),
+        ('exclude', {'emergency_contact': 'parent'}),
+        ('exclude', {'archetype': 'a1', 'pk__gte': 'pk'}),
+    ])
+    def test_filter(self, parent, django_assert_num_queries, method, kwargs):
+        children = list(parent.children.all())
+        substitutions = {'a1': children[0].archetype_id, 'pk': children[2].pk, 'parent': parent}
+        kwargs = {
+            key: type(value)(substitutions.get(v, v) for v in value) if isinstance(value, (list, tuple)) else substitutions.get(value, value)
+            for key, value in kwargs.items()
+        }
+        expected = self.expected(parent, method, **kwargs)
+
+        with django_assert_num_queries(0):
+            assert [cat.pk for cat in getattr(parent.children, method)(**kwargs)] == expected
+
+    def test_order_by(self, parent, django_assert_num_queries):
+        expected = self.expected(parent, 'order_by', 'archetype', '-pk')
+
+        with django_assert_num_queries(0):
+            assert [cat.pk for cat in parent.children.order_by('archetype', '-pk')] == expected
+            assert [cat.pk for cat in parent.children.filter(archetype=parent.children.all()[0].archetype_id).order_by('-id')] == expected[:3]
+
+    def test_shortcuts(self, parent, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            assert parent.children.count() == 6
+            assert parent.children.filter(name='Cat 2').exists()
+            assert not parent.children.filter(name='Cat 7').exists()
+            assert parent.children.filter(name='Cat 2').count() == 1
+            assert parent.children.first().name == 'Cat 0'
+            assert parent.children.last().name == 'Cat 5'
+            assert [cat.name for cat in parent.children.order_by('-pk')[:2]] == ['Cat 5', 'Cat 4']
+
+    @pytest.mark.parametrize('query', [
+        lambda children: children.filter(name__startswith='Cat'),
+        lambda children: children.filter(archetype__color='black'),
+        lambda children: children.filter(name__gt='Cat 2'),
+        lambda children: children.order_by('name'),
+        lambda children: children.order_by('emergency_contact'),
+        lambda children: children.order_by('related_to'),
+        lambda children: children.filter(Q(name='Cat 2')),
+        lambda children: children.filter(id__in=models.Cat.objects.values('pk')),
+        lambda children: children.annotate(n=Count('siblings')),
+    ])
+    def test_falls_back(self, parent, django_assert_num_queries, query):
+        with django_assert_num_queries(1):
+            list(query(parent.children))
+
+    def test_deferred_falls_back(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+        parent = models.Cat.objects.include('children', only={'children': ['name']}, in_memory=True).get(pk=parent.pk)
+
+        with django_assert_num_queries(1):
+            assert len(parent.children.filter(archetype=1)) == 0
+
+    @pytest.mark.parametrize('include, kwargs', [
+        ('children', {'limit_includes': 2}),
+        (Include('children', queryset=models.Cat.objects.exclude(name='Cat 0')), {}),
+        ('children', {'max_elements': 2, 'overflow': 'truncate'}),
+        ('children', {'max_bytes': 200, 'overflow': 'truncate'}),
+    ])
+    def test_partial_falls_back(self, django_assert_num_queries, include, kwargs):
+        a1, a2 = factories.ArchetypeFactory(), factories.ArchetypeFactory()
+        parent = factories.CatFactory()
+        for i in range(10):
+            factories.CatFactory(archetype=a1 if i % 2 == 0 else a2, parent=parent, name='Cat {}'.format(i))
+
+        parent = models.Cat.objects.include(include, in_memory=True, **kwargs).get(pk=parent.pk)
+        assert len(parent.children.all()) < 10
+
+        # Only some of the children were included, all of them have to be filtered
+        with django_assert_num_queries(1):
+            assert len(parent.children.filter(archetype=a1)) == 5
+
+    def test_normalized_partial_falls_back(self, django_assert_num_queries):
+        organizations = [models.Organization.objects.create(title=str(i)) for i in range(4)]
+        cat = factories.CatFactory()
+        for organization in organizations:
+            models.Membership.objects.create(member=cat, organization=organization)
+
+        cat = models.Cat.objects.include('organizations', normalize=True, limit_includes=2, in_memory=True).get(pk=cat.pk)
+        assert len(cat.organizations.all()) == 2
+
+        with django_assert_num_queries(1):
+            assert len(cat.organizations.filter(pk__in=[o.pk for o in organizations])) == 4
+
+    def test_opt_in(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        factories.CatFactory.create_batch(2, parent=parent)
+        parent = models.Cat.objects.include('children').get(pk=parent.pk)
+
+        with django_assert_num_queries(1):
+            assert len(parent.children.filter(pk__gt=0)) == 2
+
+    def test_lazy_and_nested(self, django_assert_num_queries):
+        parent = factories.CatFactory()
+        for child in factories.CatFactory.create_batch(2, parent=parent):
+            factories.AliasFactory(describes=child, name='Tom')
+            factories.AliasFactory(describes=child, name='Jerry')
+
+        with django_assert_num_queries(1):
+            parent = models.Cat.objects.include('children__aliases', in_memory=True, lazy=True).get(pk=parent.pk)
+            for child in parent.children.order_by('-pk'):
+                assert [alias.name for alias in child.aliases.filter(name='Tom')] == ['Tom']
+
+    def test_pickle(self, parent):
+        children = pickle.loads(pickle.dumps(parent.children.filter(name='Cat 1')))
+        assert [cat.name for cat in children] == ['Cat 1']
+        assert type(children) is type(models.Cat.objects.all())
+
+        parent = pickle.loads(pickle.dumps(parent))
+        assert len(parent.children.all()) == 6
+
+
+@pytest.mark.django_db
+class TestCountAndExists:
+
+    @pytest.fixture
+    def cat(self):
+        cat = factories.CatFactory()
+        for i in range(3):
+            child = factories.CatFactory(parent=cat)
+            factories.AliasFactory.create_batch(i, describes=child)
+        factories.AliasFactory(describes=cat)
+        models.Membership.objects.create(member=cat, organization=models.Organization.objects.create(title='Cats'))
+        return cat
+
+    def test_count(self, cat, django_assert_num_queries):
+        qs = models.Cat.objects.filter(pk=cat.pk).include_count('children', 'aliases', 'organizations', 'siblings')
+
+        with django_assert_num_queries(1):
+            result = qs.get()
+
+        assert (result.children__count, result.aliases__count, result.organizations__count, result.siblings__count) == (3, 1, 1, 0)
+        assert 'GROUP BY' not in str(qs.query)
+
+    def test_exists(self, cat, django_assert_num_queries):
+        org = models.Organization.objects.get()
+        qs = models.Organization.objects.include_exists('members', 'cat_set')
+
+        with django_assert_num_queries(1):
+            result = qs.get()
+
+        assert result.members__exists is True
+        assert result.cat_set__exists is True
+        assert models.Cat.objects.include_exists('children', 'siblings').get(pk=cat.pk).siblings__exists is False
+        assert org.members.count() == 1
+
+    def test_nested(self, cat, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            result = models.Cat.objects.include_count('children__aliases').include_exists('children__aliases').get(pk=cat.pk)
+            children = sorted(result.children.all(), key=lambda child: child.pk)
+
+            assert [child.aliases__count for child in children] == [0, 1, 2]
+            assert [child.aliases__exists for child in children] == [False, True, True]
+
+    def test_beneath_include(self, cat, django_assert_num_queries):
+        qs = models.Cat.objects.include('children__archetype', lazy=True).include_count('children__aliases')
+
+        with django_assert_num_queries(1):
+            result = qs.get(pk=cat.pk)
+            assert sorted(child.aliases__count for child in result.children.all()) == [0, 1, 2]
+            assert all(child.archetype for child in result.children.all())
+
+    def test_filtered(self, cat):
+        children = models.Cat.objects.filter(pk__in=list(cat.children.values_list('pk', flat=True)[:2]))
+        result = models.Cat.objects.include_count(Include('children', queryset=children, to_attr='some_children')).get(pk=cat.pk)
+
+        assert result.some_children == 2
+        assert not hasattr(result, 'children__count')
+
+    def test_values(self, cat):
+        rows = list(models.Cat.objects.filter(pk=cat.pk).include_count('children__aliases').include_values('name'))
+        assert sorted(child['aliases__count'] for child in rows[0]['children']) == [0, 1, 2]
+
+    def test_json(self, cat):
+        row = json.loads(models.Cat.objects.include_count('children').include_json('id').get(pk=cat.pk))
+        assert row == {'id': cat.pk, 'children__count': 3}
+
+    def test_single_valued(self):
+        with pytest.raises(ValueError, match='only many-valued relationships'):
+            models.Cat.objects.include_count('archetype')
+
+
+@pytest.mark.django_db
+class TestWithoutIncludes:
+
+    @pytest.fixture
+    def qs(self):
+        for parent in factories.CatFactory.create_batch(3):
+            factories.CatFactory.create_batch(2, parent=parent)
+        return models.Cat.objects.filter(parent__isnull=True).include('archetype', 'children__aliases').include_count('siblings')
+
+    @pytest.mark.parametrize('method, expected', [
+        (lambda qs: qs.count(), 3),
+        (lambda qs: qs.exists(), True),
+        (lambda qs: qs.aggregate(Count('pk'))['pk__count'], 3),
+        (lambda qs: len(qs.values('pk')), 3),
+        (lambda qs: len(qs.values_list('pk', flat=True)), 3),
+        (lambda qs: models.Cat.objects.filter(pk__in=qs).count(), 3),
+        (lambda qs: qs.update(name='Tom'), 3),
+    ])
+    def test_stripped(self, qs, django_assert_num_queries, method, expected):
+        with django_assert_num_queries(1) as ctx:
+            assert method(qs) == expected
+
+        sql = ctx.captured_queries[0]['sql']
+        assert 'JSON' not in sql
+        assert 'JOIN' not in sql
+        assert 'COUNT(*) FROM (' not in sql
+
+    def test_delete(self, qs):
+        # Cascades, and the collector, make for a query per related model
+        with CaptureQueriesContext(connection) as ctx:
+            qs.delete()
+
+        assert not any('JSON' in query['sql'] for query in ctx.captured_queries)
+        assert models.Cat.objects.count() == 0
+
+    def test_loaded(self, qs, django_assert_num_queries):
+        cats = qs.all()
+        list(cats)
+
+        with django_assert_num_queries(0):
+            assert cats.count() == 3
+            assert cats.exists()
+
+    def test_includes_kept(self, qs):
+        assert qs.count() == 3
+        assert [len(cat.children.all()) for cat in qs] == [2, 2, 2]
+
+
+@pytest.mark.django_db
+class TestPaginate:
+
+    @pytest.fixture
+    def parents(self):
+        parents = factories.CatFactory.create_batch(10)
+        for parent in parents:
+            factories.CatFactory.create_batch(2, parent=parent)
+        return parents
+
+    @pytest.mark.parametrize('page', [slice(0, 3), slice(4, 7), slice(8, None), slice(20, 30)])
+    def test_identical(self, parents, django_assert_num_queries, page):
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('-name', 'pk').include('archetype', 'children')
+        expected = [(cat.pk, related_pks(cat, 'children')) for cat in qs[page]]
+
+        with django_assert_num_queries(1) as ctx:
+            assert [(cat.pk, related_pks(cat, 'children')) for cat in qs.include(paginate=True)[page]] == expected
+
+        assert 'IN (SELECT' in ctx.captured_queries[0]['sql']
+
+    def test_includes_only_in_outer_query(self, parents):
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('pk').include('children', paginate=True)[2:4]
+
+        with CaptureQueriesContext(connection) as ctx:
+            list(qs)
+
+        outer, inner = ctx.captured_queries[0]['sql'].split('IN (SELECT', 1)
+        assert 'JSON_AGG' in outer
+        assert 'JSON_AGG' not in inner
+        assert 'OFFSET 2' in inner
+        assert 'OFFSET' not in outer
+
+    def test_values(self, parents):
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('pk').include('children', paginate=True)
+        rows = list(qs.include_values('id')[3:5])
+        assert [row['id'] for row in rows] == [cat.pk for cat in parents[3:5]]
+        assert [len(row['children']) for row in rows] == [2, 2]
+
+    def test_json(self, parents):
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('pk').include('children', paginate=True)
+
+        for page in (qs[3:5].include_json('id'), qs.include_json('id')[3:5]):
+            with CaptureQueriesContext(connection) as ctx:
+                rows = [json.loads(row) for row in page]
+            assert [row['id'] for row in rows] == [cat.pk for cat in parents[3:5]]
+            assert [len(row['children']) for row in rows] == [2, 2]
+            outer, inner = ctx.captured_queries[0]['sql'].split('IN (SELECT', 1)
+            assert 'JSON_AGG' not in inner
+
+        document = qs[3:5].include_json('id', aggregate=True)
+        assert [row['id'] for row in json.loads(document)] == [cat.pk for cat in parents[3:5]]
+
+    def test_index(self, parents):
+        qs = models.Cat.objects.filter(parent__isnull=True).order_by('pk').include('children', paginate=True)
+        assert qs[5] == parents[5]
+        assert len(qs[5].children.all()) == 2
+
+    def test_not_sliced(self, parents):
+        qs = models.Cat.objects.include('children', paginate=True)
+        assert qs._get_page() is qs
+        assert len(qs) == 30
+
+
+@pytest.mark.django_db
+class TestGuards:
+
+    @pytest.fixture
+    def cats(self):
+        cats = factories.CatFactory.create_batch(3)
+        for i, cat in enumerate(cats):
+            factories.AliasFactory.create_batch(i * 5, describes=cat, name='Tom')
+        return cats
+
+    @pytest.fixture
+    def row_size(self, cats):
+        # The most bytes an alias of [id, "Tom"] takes
+        return len(json.dumps([models.Alias.objects.order_by('-pk')[0].pk, 'Tom']))
+
+    @pytest.fixture
+    def overflows(self):
+        overflows = []
+
+        def receive(sender, path, plan, instance, reason, **kwargs):
+            overflows.append((sender, path, instance.pk, reason))
+
+        signals.include_overflowed.connect(receive, weak=False)
+        yield overflows
+        signals.include_overflowed.disconnect(receive)
+
+    def test_within(self, cats, overflows):
+        qs = models.Cat.objects.order_by('pk').include('aliases', max_elements=10, max_bytes=10000)
+        assert [len(cat.aliases.all()) for cat in qs] == [0, 5, 10]
+        assert not any(hasattr(cat.aliases.all(), 'truncated') for cat in qs)
+        assert overflows == []
+
+    def test_raise(self, cats, overflows):
+        with pytest.raises(IncludeLimitExceeded, match='max_elements'):
+            list(models.Cat.objects.order_by('pk').include('aliases', max_elements=7))
+
+        assert overflows == [(models.Cat, 'aliases', cats[2].pk, 'elements')]
+
+    @pytest.mark.parametrize('kwargs, reason', [
+        ({'max_elements': 7}, 'elements'),
+        ({'max_elements': {'aliases': 7}}, 'elements'),
+        ({'max_bytes': 7}, 'bytes'),
+    ])
+    def test_truncate(self, cats, overflows, django_assert_num_queries, row_size, kwargs, reason):
+        if 'max_bytes' in kwargs:
+            kwargs = {'max_bytes': kwargs['max_bytes'] * row_size}
+        qs = models.Cat.objects.order_by('pk').include('aliases', only={'aliases': ['name']}, overflow='truncate', **kwargs)
+        expected = [alias.pk for alias in cats[2].aliases.order_by('pk')]
+
+        with django_assert_num_queries(1):
+            result = list(qs)
+            aliases = result[2].aliases.all()
+
+            assert 0 < len(aliases) < 10
+            assert set(alias.pk for alias in aliases) < set(expected)
+            assert aliases.truncated is True
+            assert not hasattr(result[1].aliases.all(), 'truncated')
+
+        assert overflows == [(models.Cat, 'aliases', cats[2].pk, reason)]
+
+    def test_lazy(self, cats, overflows, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            result = list(models.Cat.objects.order_by('pk').include('aliases', max_elements=7, overflow='lazy'))
+            assert len(result[1].aliases.all()) == 5
+
+        with django_assert_num_queries(1):
+            assert len(result[2].aliases.all()) == 10
+
+        assert [reason for *_, reason in overflows] == ['elements']
+
+    def test_nested(self, cats, overflows):
+        parent = factories.CatFactory()
+        models.Cat.objects.filter(pk__in=[cat.pk for cat in cats]).update(parent=parent)
+
+        qs = models.Cat.objects.include('children__aliases', max_elements={'children__aliases': 7}, overflow='truncate')
+        children = sorted(qs.get(pk=parent.pk).children.all(), key=lambda child: child.pk)
+
+        assert [len(child.aliases.all()) for child in children] == [0, 5, 7]
+        assert overflows == [(models.Cat, 'children__aliases', cats[2].pk, 'elements')]
+
+    def test_to_attr(self, cats):
+        qs = models.Cat.objects.order_by('pk').include(Include('aliases', to_attr='names'), max_elements=7, overflow='truncate')
+        result = list(qs)
+        assert len(result[2].names) == 7
+        assert result[2].names.truncated is True
+        assert type(result[1].names) is list
+
+    def test_values(self, cats):
+        qs = models.Cat.objects.order_by('pk').include('aliases', max_elements=7)
+        with pytest.raises(IncludeLimitExceeded):
+            list(qs.include_values('id'))
+        rows = list(qs.include('aliases', max_elements=7, overflow='truncate').include_values('id'))
+        assert [len(row['aliases']) for row in rows] == [0, 5, 7]
+
+    def test_lateral(self, cats, row_size):
+        qs = models.Cat.objects.order_by('pk').include('aliases', only={'aliases': ['name']}, lateral=True, max_bytes=7 * row_size, overflow='truncate')
+        result = list(qs)
+        assert [len(cat.aliases.all()) for cat in result[:2]] == [0, 5]
+        assert 7 <= len(result[2].aliases.all()) < 10
+
+    @pytest.mark.parametrize('kwargs, message', [
+        ({'max_elements': {'archetype': 1}}, 'only applies to many-valued'),
+        ({'max_elements': 1, 'overflow': 'never'}, 'Unknown overflow'),
+    ])
+    def test_invalid(self, kwargs, message):
+        with pytest.raises(ValueError, match=message):
+            models.Cat.objects.include('archetype', **kwargs)
+
+    def test_invalid_combinations(self):
+        with pytest.raises(ValueError, match='included to an attribute'):
+            models.Cat.objects.include(Include('aliases', to_attr='names'), max_elements=1, overflow='lazy')
+        with pytest.raises(ValueError, match='normalized'):
+            models.Cat.objects.include('siblings', normalize=True, max_elements=1)
+        with pytest.raises(ValueError, match='guarded'):
+            models.Cat.objects.include('children__aliases', max_elements=1).include_json()
+
+
+@pytest.mark.django_db
+class TestIncludeObjects:
+
+    @pytest.fixture
+    def cats(self):
+        cats = factories.CatFactory.create_batch(3)
+        for cat in cats:
+            for child in factories.CatFactory.create_batch(2, parent=cat):
+                factories.AliasFactory(describes=child)
+            cat.organizations.add(models.Organization.objects.create(title=cat.name))
+        return cats
+
+    def test_identical(self, cats, django_assert_num_queries):
+        instances = list(models.Cat.objects.filter(parent__isnull=True).order_by('pk'))
+        expected = list(models.Cat.objects.filter(parent__isnull=True).order_by('pk').include('children__aliases', 'organizations'))
+
+        with django_assert_num_queries(1):
+            include_objects(instances, 'children__aliases', 'organizations')
+
+        with django_assert_num_queries(0):
+            for instance, cat in zip(instances, expected):
+                assert related_pks(instance, 'children__aliases') == related_pks(cat, 'children__aliases')
+                assert related_pks(instance, 'organizations') == related_pks(cat, 'organizations')
+                assert all(child.parent is instance for child in instance.children.all())
+
+    def test_in_place(self, cats, django_assert_num_queries):
+        cat = models.Cat.objects.get(pk=cats[0].pk)
+        cat.name = 'Unsaved'
+
+        include_objects([cat], 'archetype', Include('children', to_attr='kittens'))
+
+        with django_assert_num_queries(0):
+            assert cat.name == 'Unsaved'
+            assert cat.archetype.pk == cats[0].archetype_id
+            assert len(cat.kittens) == 2
+
+    def test_options(self, cats, django_assert_num_queries):
+        instances = list(models.Cat.objects.filter(parent__isnull=True))
+
+        with django_assert_num_queries(1):
+            include_objects(instances, 'children', limit_includes=1, lazy=True)
+
+        with django_assert_num_queries(0):
+            assert [len(instance.children.all()) for instance in instances] == [1, 1, 1]
+
+    def test_normalized_and_prefetched(self, cats, settings, django_assert_num_queries):
+        settings.INCLUDE_AUTO_MAX_BYTES = 0
+        instances = list(models.Cat.objects.filter(parent__isnull=True))
+
+        with django_assert_num_queries(1):
+            include_objects(instances, 'archetype', normalize=True)
+
+        # Estimates are queried for, and cached, before prefetching
+        include_objects(instances, 'aliases', strategy='auto')
+
+        with django_assert_num_queries(0):
+            assert all(instance.archetype.pk == instance.archetype_id for instance in instances)
+            assert all(len(instance.aliases.all()) == 0 for instance in instances)
+
+    def test_missing(self, cats):
+        deleted, unsaved = models.Cat.objects.get(pk=cats[0].pk), factories.CatFactory.build()
+        models.Cat.objects.filter(pk=deleted.pk).delete()
+
+        include_objects([deleted, unsaved, cats[1]], 'children')
+
+        assert not hasattr(deleted, '_prefetched_objects_cache')
+        assert not hasattr(unsaved, '_prefetched_objects_cache')
+        assert len(cats[1].children.all()) == 2
+
+    def test_nothing(self, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            include_objects([], 'children')
+            include_objects([factories.CatFactory.build()], 'children')
+
+    def test_mixed_models(self, cats):
+        with pytest.raises(ValueError, match='different models'):
+            include_objects([cats[0], cats[0].archetype], 'aliases')
+
+
+@pytest.mark.django_db
+class TestRecursive:
+
+    def make_chain(self, length):
+        archetype = factories.ArchetypeFactory()
+        chain = [models.Cat.objects.create(archetype=archetype, name='Cat 0')]
+        for i in range(1, length):
+            chain.append(models.Cat.objects.create(archetype=archetype, name='Cat {}'.format(i), parent=chain[-1]))
+        return chain
+
+    def test_deep(self, django_assert_num_queries):
+        chain = self.make_chain(400)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', recursive=True, max_depth=500).get(pk=chain[0].pk)
+
+        with django_assert_num_queries(0):
+            for expected in chain[1:]:
+                parent, (cat, ) = cat, cat.children.all()
+                assert cat.pk == expected.pk
+                assert cat.parent is parent
+            assert list(cat.children.all()) == []
+
+    def test_max_depth(self, django_assert_num_queries):
+        chain = self.make_chain(10)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', recursive=True, max_depth=3).get(pk=chain[0].pk)
+            for _ in range(3):
+                cat, = cat.children.all()
+
+        # The children of the deepest included cat were not loaded
+        with django_assert_num_queries(1):
+            assert [child.pk for child in cat.children.all()] == [chain[4].pk]
+
+    @pytest.mark.parametrize('max_depth', [1, 2, 3])
+    def test_identical(self, django_assert_num_queries, max_depth):
+        root = factories.CatFactory()
+        level = [root]
+        for _ in range(3):
+            level = [child for parent in level for child in factories.CatFactory.create_batch(3, parent=parent)]
+
+        path = '__'.join(['children'] * max_depth)
+        expected = models.Cat.objects.include(path).get(pk=root.pk)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', recursive=True, max_depth=max_depth).get(pk=root.pk)
+            # Cats have no default ordering, nested includes come back in whatever order the database likes
+            assert sorted(related_pks(cat, path)) == sorted(related_pks(expected, path))
+            assert len(related_pks(cat, path)) == 3 ** max_depth
+
+    def test_many_roots(self, django_assert_num_queries):
+        roots = factories.CatFactory.create_batch(3)
+        for root in roots:
+            for child in factories.CatFactory.create_batch(2, parent=root):
+                factories.CatFactory(parent=child)
+
+        with django_assert_num_queries(1):
+            cats = list(models.Cat.objects.filter(pk__in=[root.pk for root in roots]).order_by('pk').include('children', recursive=True, max_depth=5))
+            assert [len(related_pks(cat, 'children__children')) for cat in cats] == [2, 2, 2]
+            assert all(len(related_pks(cat, 'children__children__children')) == 0 for cat in cats)
+
+    def test_values(self):
+        chain = self.make_chain(3)
+        rows = list(models.Cat.objects.filter(pk=chain[0].pk).include('children', recursive=True, max_depth=1, only={'children': ['name']}).include_values('name'))
+
+        # Deferred foreign keys are loaded regardless, to assemble the tree
+        assert rows == [{'name': 'Cat 0', 'children': [{'id': chain[1].pk, 'name': 'Cat 1', 'parent_id': chain[0].pk}]}]
+
+    def test_lateral(self, django_assert_num_queries):
+        chain = self.make_chain(5)
+
+        with django_assert_num_queries(1):
+            cat = models.Cat.objects.include('children', recursive=True, max_depth=10, lateral=True).get(pk=chain[0].pk)
+            assert len(related_pks(cat, '__'.join(['children'] * 4))) == 1
+
+    @pytest.mark.parametrize('args, kwargs, message', [
+        (('children', ), {'recursive': True}, 'max_depth'),
+        (('archetype', ), {'recursive': True, 'max_depth': 2}, 'self-referential reverse foreign keys'),
+        (('siblings', ), {'recursive': True, 'max_depth': 2}, 'self-referential reverse foreign keys'),
+        ((Include('children', to_attr='kittens'), ), {'recursive': True, 'max_depth': 2}, 'no queryset or to_attr'),
+        (('children', ), {'recursive': True, 'max_depth': 2, 'limit_includes': 2}, 'included recursively'),
+    ])
+    def test_invalid(self, args, kwargs, message):
+        with pytest.raises(ValueError, match=message):
+            models.Cat.objects.include(*args, **kwargs)
+
+    def test_include_beneath(self):
+        with pytest.raises(ValueError, match='included recursively'):
+            models.Cat.objects.include('children', recursive=True, max_depth=2).include('children__aliases')